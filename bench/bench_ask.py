@@ -0,0 +1,90 @@
+"""Latency of concurrent /ask requests, and of /health while they run.
+
+The agent is the real one with a scripted LLM and a blocking stub tool, so a
+slow /health means something still blocks the event loop.
+
+    python bench/bench_ask.py --requests 200 --concurrency 50
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+from common import ScriptedLLM, build_agent, describe, stub_tool
+from auth import PasswordVerifier, RevocationStore, hash_password
+from server import WebServer
+from tools.budget import TokenBudget
+
+PASSWORD = "benchmark"
+
+
+async def main(args: argparse.Namespace) -> None:
+    llm = ScriptedLLM(latency=args.llm_latency, steps=args.steps)
+    agent = build_agent(llm, [stub_tool(args.tool_latency)])
+    directory = tempfile.mkdtemp()
+    server = WebServer(
+        agent,
+        PasswordVerifier(hash_password(PASSWORD)),
+        TokenBudget(),
+        max_concurrency=args.max_concurrency,
+        revocations=RevocationStore(os.path.join(directory, "revoked.sqlite")),
+    )
+    test_server = TestServer(server.build_app())
+    await test_server.start_server()
+    base = str(test_server.make_url(""))
+    async with ClientSession() as session:
+        async with session.post(
+            f"{base}/create_token", json={"password": PASSWORD}
+        ) as response:
+            token = (await response.json())["token"]
+        headers = {"Authorization": token}
+        ask_latencies, health_latencies = [], []
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def ask(index: int) -> None:
+            async with slots:
+                started = time.perf_counter()
+                async with session.post(
+                    f"{base}/ask", json={"input": f"question {index}"}, headers=headers
+                ) as response:
+                    assert "content" in await response.json()
+                ask_latencies.append(time.perf_counter() - started)
+
+        async def probe(done: asyncio.Event) -> None:
+            while not done.is_set():
+                started = time.perf_counter()
+                async with session.get(f"{base}/health") as response:
+                    await response.read()
+                health_latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.01)
+
+        done = asyncio.Event()
+        prober = asyncio.create_task(probe(done))
+        started = time.perf_counter()
+        await asyncio.gather(*[ask(index) for index in range(args.requests)])
+        elapsed = time.perf_counter() - started
+        done.set()
+        await prober
+    await test_server.close()
+
+    print(describe("/ask", ask_latencies))
+    print(describe("/health during the load", health_latencies))
+    print(f"throughput: {args.requests / elapsed:.1f} questions/s over {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--concurrency", type=int, default=50, help="requests in flight"
+    )
+    parser.add_argument(
+        "--max-concurrency", type=int, default=16, help="server agent slots"
+    )
+    parser.add_argument("--steps", type=int, default=2, help="tool calls per question")
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--tool-latency", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
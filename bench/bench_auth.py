@@ -0,0 +1,86 @@
+"""Per-request cost of checking a JWT, with and without the verified tokens cache.
+
+Compares a bare jwt.decode with TokenVerifier on its first sight of each token
+and on tokens it already verified, while the revocation store holds
+--revoked ids.
+
+    python bench/bench_auth.py --tokens 1000 --revoked 10000
+"""
+
+import os
+import sys
+import time
+import uuid
+import argparse
+import datetime
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "j4rvis"))
+
+import jwt  # noqa: E402
+from auth import RevocationStore, TokenVerifier  # noqa: E402
+
+SECRET_KEY = "benchmark secret key"
+
+
+def issue(count: int) -> list:
+    expires = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    return [
+        jwt.encode(
+            {"exp": expires, "jti": uuid.uuid4().hex}, SECRET_KEY, algorithm="HS256"
+        )
+        for _ in range(count)
+    ]
+
+
+def per_call(check, tokens: list, rounds: int) -> float:
+    """Microseconds per check of a token."""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for token in tokens:
+            assert check(token) is not None
+    return (time.perf_counter() - started) / (rounds * len(tokens)) * 1e6
+
+
+def main(args: argparse.Namespace) -> None:
+    revocations = RevocationStore(os.path.join(tempfile.mkdtemp(), "revoked.sqlite"))
+    expires = time.time() + 86400
+    for _ in range(args.revoked):
+        revocations.revoke(uuid.uuid4().hex, expires)
+    tokens = issue(args.tokens)
+
+    decode = per_call(
+        lambda token: jwt.decode(token, SECRET_KEY, algorithms="HS256"),
+        tokens,
+        args.rounds,
+    )
+    print(f"jwt.decode alone: {decode:.1f}us")
+
+    verifier = TokenVerifier(SECRET_KEY, revocations, cache_size=args.tokens)
+    print(f"TokenVerifier, first sight: {per_call(verifier.verify, tokens, 1):.1f}us")
+    print(
+        f"TokenVerifier, cached: {per_call(verifier.verify, tokens, args.rounds):.1f}us"
+    )
+
+    # A revocation from another process makes every verifier reload the revoked ids
+    other = RevocationStore(
+        revocations.db.execute("PRAGMA database_list").fetchone()[2]
+    )
+    other.revoke(uuid.uuid4().hex, expires)
+    started = time.perf_counter()
+    verifier.verify(tokens[0])
+    reload = (time.perf_counter() - started) * 1e6
+    print(f"first check after a revocation elsewhere: {reload:.1f}us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--tokens", type=int, default=1000, help="distinct tokens checked"
+    )
+    parser.add_argument(
+        "--revoked", type=int, default=10000, help="ids in the revocation store"
+    )
+    parser.add_argument("--rounds", type=int, default=20)
+    main(parser.parse_args())
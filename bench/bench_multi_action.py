@@ -0,0 +1,57 @@
+"""Wall time of a question needing several independent tool calls, multi-action vs single-action.
+
+With multi-action the scripted LLM asks for every call in one turn and the
+executor runs them concurrently, single-action takes one turn per call. The
+LLM calls per answer are printed with the timings.
+
+    python bench/bench_multi_action.py --actions 5
+"""
+
+import time
+import asyncio
+import argparse
+from typing import List, Tuple
+from common import ScriptedLLM, build_agent, describe, stub_tool
+
+
+async def measure(
+    multi_action: bool, args: argparse.Namespace
+) -> Tuple[List[float], float]:
+    llm = ScriptedLLM(
+        latency=args.llm_latency,
+        steps=args.actions,
+        per_turn=args.actions if multi_action else 1,
+    )
+    agent = build_agent(llm, [stub_tool(args.tool_latency)], multi_action=multi_action)
+    durations = []
+    for index in range(args.runs):
+        started = time.perf_counter()
+        result = await agent.acall({"input": f"question {index}", "history": ""})
+        durations.append(time.perf_counter() - started)
+        assert len(result["intermediate_steps"]) == args.actions
+    return durations, llm.calls / args.runs
+
+
+async def main(args: argparse.Namespace) -> None:
+    for multi_action in (True, False):
+        label = "multi-action" if multi_action else "single-action"
+        durations, calls = await measure(multi_action, args)
+        print(f"{describe(label, durations)} llm_calls/answer={calls:.1f}")
+    # One turn for the actions and one for the answer, against one turn per action
+    multi = 2 * args.llm_latency + args.tool_latency
+    single = (args.actions + 1) * args.llm_latency + args.actions * args.tool_latency
+    print(
+        f"expected: multi-action ~{multi * 1000:.0f}ms, single-action ~{single * 1000:.0f}ms"
+    )
+    print(
+        f"expected: multi-action 2 llm calls/answer, single-action {args.actions + 1}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--actions", type=int, default=5, help="independent tool calls")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--tool-latency", type=float, default=0.3)
+    asyncio.run(main(parser.parse_args()))
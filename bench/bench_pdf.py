@@ -0,0 +1,80 @@
+"""Cold and warm HTML to PDF conversions through the renderer pool.
+
+Cold conversions render documents never seen before with wkhtmltopdf, warm
+ones convert the same documents again and are copied from the PDF cache.
+Needs wkhtmltopdf on the PATH, nothing else is stubbed.
+
+    python bench/bench_pdf.py --documents 8 --concurrency 4
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "j4rvis"))
+
+from tools.pdf_tools import PDFRenderer  # noqa: E402
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def write_document(directory: str, index: int, paragraphs: int) -> tuple:
+    html_path = os.path.join(directory, f"document-{index}.html")
+    css_path = os.path.join(directory, f"document-{index}.css")
+    with open(html_path, "w", encoding="utf-8") as file:
+        file.write(f"<html><body><h1>Document {index}</h1>")
+        file.write(
+            "".join(
+                f"<p>Paragraph {i} of document {index}.</p>" for i in range(paragraphs)
+            )
+        )
+        file.write("</body></html>")
+    with open(css_path, "w", encoding="utf-8") as file:
+        file.write("body { font-family: serif; } h1 { color: #333; }")
+    return html_path, css_path
+
+
+def convert(renderer: PDFRenderer, paths: tuple) -> float:
+    started = time.perf_counter()
+    renderer.submit(*paths).result()
+    return time.perf_counter() - started
+
+
+def main(args: argparse.Namespace) -> None:
+    directory = tempfile.mkdtemp()
+    renderer = PDFRenderer(os.path.join(directory, "cache"), args.workers, args.timeout)
+    documents = [
+        write_document(directory, i, args.paragraphs) for i in range(args.documents)
+    ]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for label in ("cold", "warm"):
+            started = time.perf_counter()
+            durations = list(
+                pool.map(lambda paths: convert(renderer, paths), documents)
+            )
+            elapsed = time.perf_counter() - started
+            print(
+                f"{label}: n={len(durations)} p50={percentile(durations, 50) * 1000:.1f}ms "
+                f"p99={percentile(durations, 99) * 1000:.1f}ms total={elapsed * 1000:.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--documents", type=int, default=8)
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="conversions requested at once"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="wkhtmltopdf jobs at once"
+    )
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60)
+    main(parser.parse_args())
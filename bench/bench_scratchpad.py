@@ -0,0 +1,65 @@
+"""Cost of formatting the agent prompt as the scratchpad grows from 1 to 50 steps.
+
+The executor appends to one list of steps, which the prompt formats
+incrementally. Passing a copy of the list every turn forces a full
+formatting, like before the scratchpad was cached.
+
+    python bench/bench_scratchpad.py --steps 50
+"""
+
+import time
+import argparse
+from langchain.schema import AgentAction
+from common import STUB_OBSERVATION, build_prompt, stub_tool
+from tools.budget import TokenBudget
+
+
+def run(prompt, steps: int, observation: str, incremental: bool) -> list:
+    """Seconds spent formatting the prompt of each turn."""
+    intermediate_steps, durations = [], []
+    for step in range(steps):
+        action = AgentAction(
+            tool="Stub",
+            tool_input=f"step {step}",
+            log=f"Thought: one more step\nAction: Stub\nAction Input: step {step}",
+        )
+        intermediate_steps.append((action, observation))
+        started = time.perf_counter()
+        prompt.format_messages(
+            input="benchmark question",
+            history="",
+            intermediate_steps=(
+                intermediate_steps if incremental else list(intermediate_steps)
+            ),
+        )
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def main(args: argparse.Namespace) -> None:
+    observation = f"{STUB_OBSERVATION} " + "lorem ipsum " * args.observation_words
+    # Without --budget only the formatting is measured, the huge budget never elides
+    budget = TokenBudget(max_prompt_tokens=10**9) if args.budget else None
+    for incremental in (True, False):
+        prompt = build_prompt([stub_tool(0)], budget)
+        durations = run(prompt, args.steps, observation, incremental)
+        label = "incremental" if incremental else "from scratch"
+        checkpoints = [1, 10, 25, 50, args.steps]
+        per_step = " ".join(
+            f"{step}:{durations[step - 1] * 1000:.2f}ms"
+            for step in sorted(set(checkpoints))
+            if step <= args.steps
+        )
+        print(f"{label}: total={sum(durations) * 1000:.1f}ms per step {per_step}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--observation-words", type=int, default=200)
+    parser.add_argument(
+        "--budget",
+        action="store_true",
+        help="also count the prompt tokens, as the server does",
+    )
+    main(parser.parse_args())
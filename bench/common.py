@@ -0,0 +1,143 @@
+"""Stand-ins shared by the benchmarks: a scripted LLM, a stub tool and the agent around them.
+
+Nothing here calls OpenAI or any other service, latencies are simulated with
+sleeps so the numbers only measure j4rvis itself.
+"""
+
+import os
+import sys
+import time
+import asyncio
+from typing import Any, List, Optional
+
+# The benchmarks import the server modules the way it runs, from the j4rvis directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "j4rvis"))
+
+from langchain import LLMChain  # noqa: E402
+from langchain.agents import AgentExecutor, Tool  # noqa: E402
+from langchain.llms.base import LLM  # noqa: E402
+from agent import (
+    CustomOutputParser,
+    CustomPromptTemplate,
+    LLMMultiActionAgent,
+)  # noqa: E402
+from prompt import get_j4rvis_template  # noqa: E402
+from tools.budget import TokenBudget  # noqa: E402
+from tools.executor import to_async  # noqa: E402
+
+STUB_OBSERVATION = "stub observation"
+
+# Enough of a config to render the real prompt
+CONFIG = {
+    "employer": {
+        "name": "Tony",
+        "full_name": "Tony Stark",
+        "email": "tony@example.com",
+        "phone": "+1 555 0100",
+        "siret": "00000000000000",
+        "bank_name": "Bank",
+        "iban": "FR00 0000 0000 0000",
+    },
+    "agent": {"multi_action": True},
+}
+
+
+class ScriptedLLM(LLM):
+    """Takes `steps` actions, `per_turn` at a time, then answers, `latency` seconds per call.
+
+    `calls` counts the completions it was asked for.
+    """
+
+    latency: float = 0.05
+    steps: int = 1
+    per_turn: int = 1
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _reply(self, prompt: str) -> str:
+        done = prompt.count(STUB_OBSERVATION)
+        if done >= self.steps:
+            return "Thought: I now know the final answer\nFinal Answer: done"
+        count = min(self.per_turn, self.steps - done)
+        if count == 1:
+            return f"Thought: one more step\nAction: Stub\nAction Input: step {done}"
+        return "Thought: independent steps\n" + "\n".join(
+            f"Action {i + 1}: Stub\nAction {i + 1} Input: step {done + i}"
+            for i in range(count)
+        )
+
+    def _call(
+        self, prompt: str, stop: Optional[List[str]] = None, **kwargs: Any
+    ) -> str:
+        self.calls += 1
+        time.sleep(self.latency)
+        return self._reply(prompt)
+
+    async def _acall(
+        self, prompt: str, stop: Optional[List[str]] = None, **kwargs: Any
+    ) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self._reply(prompt)
+
+
+def stub_tool(latency: float, timeout: float = 60) -> Tool:
+    """A blocking tool, run off the event loop like the real ones."""
+
+    def stub(txt: str) -> str:
+        time.sleep(latency)
+        return f"{STUB_OBSERVATION} for {txt}"
+
+    return Tool(
+        name="Stub",
+        func=stub,
+        coroutine=to_async(stub, timeout),
+        description="A stand-in tool, input is any text.",
+    )
+
+
+def build_prompt(
+    tools: List[Tool], budget: Optional[TokenBudget] = None
+) -> CustomPromptTemplate:
+    return CustomPromptTemplate(
+        template=get_j4rvis_template(CONFIG),
+        tools=tools,
+        budget=budget,
+        input_variables=["input", "history", "intermediate_steps"],
+    )
+
+
+def build_agent(
+    llm: ScriptedLLM, tools: List[Tool], multi_action: bool = True
+) -> AgentExecutor:
+    """The agent of agent.create_agent, with the scripted LLM and the given tools."""
+    agent = LLMMultiActionAgent(
+        llm_chain=LLMChain(llm=llm, prompt=build_prompt(tools, TokenBudget())),
+        output_parser=CustomOutputParser(multi_action=multi_action),
+        stop=["\nObservation:", "\nObservation 1:"],
+        allowed_tools=[tool.name for tool in tools],
+    )
+    return AgentExecutor.from_agent_and_tools(
+        agent=agent,
+        tools=tools,
+        verbose=False,
+        return_intermediate_steps=True,
+        max_iterations=None,
+    )
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def describe(name: str, samples: List[float]) -> str:
+    """p50, p99 and max of durations in seconds, printed in milliseconds."""
+    return (
+        f"{name}: n={len(samples)} p50={percentile(samples, 50) * 1000:.1f}ms "
+        f"p99={percentile(samples, 99) * 1000:.1f}ms max={max(samples) * 1000:.1f}ms"
+    )
@@ -1,12 +1,23 @@
 from agent import create_agent
 from server import WebServer
-from auth import hash_password
+from auth import (
+    build_login_limiter,
+    build_password_verifier,
+    build_revocation_store,
+)
 from langchain.agents import AgentExecutor
 from prompt import get_j4rvis_template
+from tools.budget import TokenBudget
+from semantic_cache import build_semantic_cache
+from memory import build_conversation_memory
+from jobs import build_job_queue
+from supervisor import Supervisor, heartbeat
 from aiohttp import web
-from typing import Any
+from typing import Any, Optional
 import tomllib
 import asyncio
+import secrets
+import signal
 import os
 
 
@@ -21,21 +32,69 @@ def load_api_keys(config: dict[str, Any]):
     os.environ["GOOGLE_API_KEY"] = config["api"]["google_api_key"]
 
 
-async def start_server(config: dict[str, Any], agent: AgentExecutor):
-    app = WebServer(agent, hash_password(config["server"]["password"])).build_app()
-    runner = web.AppRunner(app)
+async def start_server(
+    config: dict[str, Any],
+    agent: AgentExecutor,
+    budget: TokenBudget,
+    heartbeat_fd: Optional[int] = None,
+):
+    app = WebServer(
+        agent,
+        build_password_verifier(config),
+        budget,
+        config["server"].get("max_concurrency", 4),
+        build_semantic_cache(config),
+        build_conversation_memory(config, budget),
+        build_revocation_store(config),
+        build_login_limiter(config),
+        config["server"].get("secret_key"),
+        build_job_queue(config),
+        batch_parallelism=config["server"].get("batch_parallelism", 4),
+        batch_concurrency=config["server"].get("batch_concurrency", 8),
+        max_batch_size=config["server"].get("max_batch_size", 50),
+        trusted_proxies=config["server"].get("trusted_proxies", []),
+    ).build_app()
+    runner = web.AppRunner(
+        app, shutdown_timeout=config["server"].get("shutdown_timeout", 60)
+    )
     await runner.setup()
-    await web.TCPSite(runner, port=config["server"]["port"]).start()
+    # Workers of the supervisor all listen on the same port
+    await web.TCPSite(
+        runner, port=config["server"]["port"], reuse_port=heartbeat_fd is not None
+    ).start()
     stop_event = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    if heartbeat_fd is not None:
+        # Kept referenced by the app so the task lives as long as the server
+        app["heartbeat"] = asyncio.create_task(
+            heartbeat(heartbeat_fd, config["server"].get("heartbeat_interval", 5))
+        )
     await stop_event.wait()
+    # Stop accepting connections and let the running requests finish
+    await runner.cleanup()
+    if "heartbeat" in app:
+        app["heartbeat"].cancel()
 
 
-async def main():
-    config = load_config()
-    load_api_keys(config)
-    agent = create_agent(config, get_j4rvis_template(config))
-    server_task = start_server(config, agent)
+async def main(config: dict[str, Any], heartbeat_fd: Optional[int] = None):
+    budget = TokenBudget.from_config(config)
+    agent = create_agent(config, get_j4rvis_template(config), budget)
+    server_task = start_server(config, agent, budget, heartbeat_fd)
     await asyncio.gather(server_task)
 
 
-asyncio.run(main())
+config = load_config()
+load_api_keys(config)
+workers = config["server"].get("workers", 1)
+if workers > 1:
+    # Every worker must sign and verify the same tokens
+    config["server"].setdefault("secret_key", secrets.token_hex(32))
+    Supervisor(
+        lambda heartbeat_fd: asyncio.run(main(config, heartbeat_fd)),
+        workers,
+        config["server"].get("heartbeat_timeout", 60),
+        config["server"].get("startup_timeout", 120),
+        config["server"].get("shutdown_timeout", 60),
+    ).run()
+else:
+    asyncio.run(main(config))
@@ -1,43 +1,147 @@
 import re
 import openai
-from typing import List, Union, Dict, Any, Tuple
+from collections import OrderedDict
+from string import Formatter
+from typing import List, Union, Dict, Any, Tuple, Optional
+from pydantic import PrivateAttr
 from langchain.agents import (
     Tool,
     AgentExecutor,
-    BaseSingleActionAgent,
+    BaseMultiActionAgent,
     AgentOutputParser,
 )
 from langchain.callbacks.manager import Callbacks
 from langchain import LLMChain
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts import BaseChatPromptTemplate
 from langchain.schema import AgentAction, AgentFinish, HumanMessage
 from tools.define_tools import define_tools
+from tools.budget import TokenBudget
+from tools.llm_cache import CachedChatOpenAI
 from datetime import datetime
 
+# Scratchpads kept around for incremental formatting, one per running agent
+MAX_CACHED_SCRATCHPADS = 32
+
 
 class CustomPromptTemplate(BaseChatPromptTemplate):
     template: str
     tools: List[Tool]
+    budget: Optional[TokenBudget] = None
+    # The template split in (literal text, field to fill) pairs, tools already rendered
+    _segments: List[Tuple[str, Optional[str]]] = PrivateAttr(default_factory=list)
+    # Scratchpads of the running agents: id(steps) -> (steps count, last step, chunks)
+    _scratchpads: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._segments = self._compile()
+
+    def _compile(self) -> List[Tuple[str, Optional[str]]]:
+        static = {
+            "tools": "\n".join(
+                [f"{tool.name}: {tool.description}" for tool in self.tools]
+            ),
+            "tool_names": ", ".join([tool.name for tool in self.tools]),
+        }
+        segments = []
+        literal = ""
+        for text, field, _, _ in Formatter().parse(self.template):
+            literal += text
+            if field is None:
+                continue
+            if field in static:
+                literal += static[field]
+            else:
+                segments.append((literal, field))
+                literal = ""
+        segments.append((literal, None))
+        return segments
+
+    @staticmethod
+    def _format_step(
+        intermediate_steps: List[Tuple[AgentAction, str]], i: int, observation: str
+    ) -> str:
+        action = intermediate_steps[i][0]
+        # Actions decided together share the log of the first one, their observations
+        # are numbered and followed by a single new thought
+        group_start = i
+        while group_start > 0 and not intermediate_steps[group_start][0].log:
+            group_start -= 1
+        last = i + 1 == len(intermediate_steps) or bool(
+            intermediate_steps[i + 1][0].log
+        )
+        if last and i == group_start:
+            label = "Observation"
+        else:
+            label = f"Observation {i - group_start + 1}"
+        return f"{action.log}\n{label}: {observation}" + ("\nThought: " if last else "")
+
+    def _scratchpad(
+        self, intermediate_steps: List[Tuple[AgentAction, str]]
+    ) -> List[str]:
+        key = id(intermediate_steps)
+        count, last, chunks = self._scratchpads.get(key, (0, None, []))
+        # The executor keeps appending to the same list, so only the new steps are formatted
+        if count > len(intermediate_steps) or (
+            count and intermediate_steps[count - 1] is not last
+        ):
+            count, chunks = 0, []
+        chunks = chunks + [
+            self._format_step(intermediate_steps, i, intermediate_steps[i][1])
+            for i in range(count, len(intermediate_steps))
+        ]
+        if intermediate_steps:
+            self._scratchpads[key] = (
+                len(intermediate_steps),
+                intermediate_steps[-1],
+                chunks,
+            )
+            self._scratchpads.move_to_end(key)
+            while len(self._scratchpads) > MAX_CACHED_SCRATCHPADS:
+                self._scratchpads.popitem(last=False)
+        return chunks
+
+    def _render(self, values: Dict[str, Any]) -> str:
+        return "".join(
+            [
+                literal if field is None else literal + str(values[field])
+                for literal, field in self._segments
+            ]
+        )
 
     def format_messages(self, **kwargs) -> str:
         intermediate_steps = kwargs.pop("intermediate_steps")
-        thoughts = ""
-        for action, observation in intermediate_steps:
-            thoughts += action.log
-            thoughts += f"\nObservation: {observation}\nThought: "
-        kwargs["agent_scratchpad"] = thoughts
-        kwargs["tools"] = "\n".join(
-            [f"{tool.name}: {tool.description}" for tool in self.tools]
-        )
-        kwargs["tool_names"] = ", ".join([tool.name for tool in self.tools])
+        chunks = self._scratchpad(intermediate_steps)
+        kwargs["agent_scratchpad"] = "".join(chunks)
         kwargs["current_datetime"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        formatted = self.template.format(**kwargs)
+        formatted = self._render(kwargs)
+        if self.budget is None:
+            return [HumanMessage(content=formatted)]
+
+        # Elide the oldest observations until the prompt fits in the budget
+        overflow = self.budget.count(formatted) - self.budget.max_prompt_tokens
+        if overflow > 0:
+            chunks = list(chunks)
+            for i in range(len(intermediate_steps)):
+                if overflow <= 0:
+                    break
+                elided = self._format_step(
+                    intermediate_steps, i, "[elided to fit the token budget]"
+                )
+                overflow -= self.budget.count(chunks[i]) - self.budget.count(elided)
+                chunks[i] = elided
+            kwargs["agent_scratchpad"] = "".join(chunks)
+            formatted = self._render(kwargs)
         return [HumanMessage(content=formatted)]
 
 
 class CustomOutputParser(AgentOutputParser):
-    def parse(self, llm_output: str) -> Union[AgentAction, AgentFinish]:
+    # Accept several numbered actions in one LLM turn
+    multi_action: bool = True
+
+    def parse(
+        self, llm_output: str
+    ) -> Union[AgentAction, List[AgentAction], AgentFinish]:
         # Check if agent should finish
         if "Final Answer:" in llm_output:
             return AgentFinish(
@@ -46,6 +150,24 @@ class CustomOutputParser(AgentOutputParser):
                 return_values={"output": llm_output.split("Final Answer:")[-1].strip()},
                 log=llm_output,
             )
+        # Parse out several numbered actions, "Action 1:", "Action 1 Input:", ...
+        if self.multi_action:
+            regex = (
+                r"Action\s*(\d+)\s*:(.*?)\nAction\s*\1\s*Input\s*:[\s]*(.*?)"
+                r"(?=\n\s*Action\s*\d+\s*:|\Z)"
+            )
+            matches = re.findall(regex, llm_output, re.DOTALL)
+            if len(matches) > 1:
+                # Only the first action carries the log so the scratchpad shows it once
+                return [
+                    AgentAction(
+                        tool=action.strip(),
+                        tool_input=action_input.strip().strip('"'),
+                        log=llm_output if i == 0 else "",
+                    )
+                    for i, (_, action, action_input) in enumerate(matches)
+                ]
+
         # Parse out the action and action input
         regex = r"Action\s*\d*\s*:(.*?)\nAction\s*\d*\s*Input\s*\d*\s*:[\s]*(.*)"
         match = re.search(regex, llm_output, re.DOTALL)
@@ -63,7 +185,7 @@ class CustomOutputParser(AgentOutputParser):
         )
 
 
-class LLMSingleActionAgent(BaseSingleActionAgent):
+class LLMMultiActionAgent(BaseMultiActionAgent):
     llm_chain: LLMChain
     output_parser: AgentOutputParser
     stop: List[str]
@@ -72,12 +194,23 @@ class LLMSingleActionAgent(BaseSingleActionAgent):
     def input_keys(self) -> List[str]:
         return list(set(self.llm_chain.input_keys) - {"intermediate_steps"})
 
+    @staticmethod
+    def _as_actions(
+        output: Union[AgentAction, List[AgentAction], AgentFinish],
+    ) -> Union[List[AgentAction], AgentFinish]:
+        return [output] if isinstance(output, AgentAction) else output
+
+    @staticmethod
+    def _finish(message: str) -> AgentFinish:
+        # The executor only accepts actions or a finish, errors end the run with a message
+        return AgentFinish(return_values={"output": message}, log=message)
+
     def plan(
         self,
         intermediate_steps: List[Tuple[AgentAction, str]],
         callbacks: Callbacks = None,
         **kwargs: Any,
-    ) -> Union[AgentAction, AgentFinish]:
+    ) -> Union[List[AgentAction], AgentFinish]:
         """Given input, decided what to do.
 
         Args:
@@ -87,7 +220,7 @@ class LLMSingleActionAgent(BaseSingleActionAgent):
             **kwargs: User inputs.
 
         Returns:
-            Action specifying what tool to use.
+            Actions specifying what tools to use, run concurrently by the executor.
         """
         try:
             output = self.llm_chain.run(
@@ -97,19 +230,46 @@ class LLMSingleActionAgent(BaseSingleActionAgent):
                 **kwargs,
             )
         except openai.error.InvalidRequestError:
-            return "Your request is invalid, it might exceed my capabilities."
+            return self._finish(
+                "Your request is invalid, it might exceed my capabilities."
+            )
         try:
-            return self.output_parser.parse(output)
+            return self._as_actions(self.output_parser.parse(output))
         except ValueError:
-            return "A parsing error happened, sorry"
+            return self._finish("A parsing error happened, sorry")
 
     async def aplan(
         self,
         intermediate_steps: List[Tuple[AgentAction, str]],
         callbacks: Callbacks = None,
         **kwargs: Any,
-    ) -> Union[AgentAction, AgentFinish]:
-        pass
+    ) -> Union[List[AgentAction], AgentFinish]:
+        """Given input, decided what to do, without blocking the event loop.
+
+        Args:
+            intermediate_steps: Steps the LLM has taken to date,
+                along with observations
+            callbacks: Callbacks to run.
+            **kwargs: User inputs.
+
+        Returns:
+            Actions specifying what tools to use, run concurrently by the executor.
+        """
+        try:
+            output = await self.llm_chain.arun(
+                intermediate_steps=intermediate_steps,
+                stop=self.stop,
+                callbacks=callbacks,
+                **kwargs,
+            )
+        except openai.error.InvalidRequestError:
+            return self._finish(
+                "Your request is invalid, it might exceed my capabilities."
+            )
+        try:
+            return self._as_actions(self.output_parser.parse(output))
+        except ValueError:
+            return self._finish("A parsing error happened, sorry")
 
     def tool_run_logging_kwargs(self) -> Dict:
         return {
@@ -118,27 +278,34 @@ class LLMSingleActionAgent(BaseSingleActionAgent):
         }
 
 
-def create_agent(config: dict[str, Any], template: str) -> AgentExecutor:
-    tools = define_tools(config)
+def create_agent(
+    config: dict[str, Any], template: str, budget: TokenBudget
+) -> AgentExecutor:
+    tools = define_tools(config, budget)
     prompt = CustomPromptTemplate(
         template=template,
         tools=tools,
+        budget=budget,
         # This omits the `agent_scratchpad`, `tools`, and `tool_names` variables because those are generated dynamically
         # This includes the `intermediate_steps` variable because that is needed
-        input_variables=["input", "intermediate_steps"],
+        # `history` is the conversation so far, empty for a new conversation
+        input_variables=["input", "history", "intermediate_steps"],
+    )
+    output_parser = CustomOutputParser(
+        multi_action=config.get("agent", {}).get("multi_action", True)
     )
-    output_parser = CustomOutputParser()
-    gpt4_llm = ChatOpenAI(model_name="gpt-4", temperature=0.25)
+    # Streaming lets the callbacks of /ask_stream see every token as it arrives
+    gpt4_llm = CachedChatOpenAI(model_name="gpt-4", temperature=0.25, streaming=True)
     llm_chain = LLMChain(llm=gpt4_llm, prompt=prompt)
     tool_names = [tool.name for tool in tools]
-    agent = LLMSingleActionAgent(
+    agent = LLMMultiActionAgent(
         llm_chain=llm_chain,
         output_parser=output_parser,
-        stop=["\nObservation:"],
+        stop=["\nObservation:", "\nObservation 1:"],
         allowed_tools=tool_names,
     )
     agent_executor = AgentExecutor.from_agent_and_tools(
-        agent=agent, tools=tools, verbose=True
+        agent=agent, tools=tools, verbose=True, return_intermediate_steps=True
     )
 
     return agent_executor
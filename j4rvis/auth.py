@@ -1,4 +1,15 @@
+import os
+import time
+import asyncio
+import sqlite3
+import secrets
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Set
 import bcrypt
+import jwt
 
 
 def hash_password(password: str) -> bytes:
@@ -7,3 +18,200 @@ def hash_password(password: str) -> bytes:
 
 def verify_password(password: str, password_hash: bytes()) -> bool:
     return bcrypt.checkpw(password.encode("utf-8"), password_hash)
+
+
+class VerifierBusy(Exception):
+    pass
+
+
+class PasswordVerifier:
+    """Checks passwords against the bcrypt hash on its own threads, off the event loop.
+
+    Attempts beyond max_pending are refused instead of queued, and a password
+    that was just verified is accepted again without paying for bcrypt.
+    """
+
+    def __init__(
+        self,
+        password_hash: bytes,
+        workers: int = 2,
+        max_pending: int = 8,
+        cache_ttl: float = 300,
+    ) -> None:
+        self.password_hash = password_hash
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="j4rvis-bcrypt"
+        )
+        self.max_pending = max_pending
+        self.pending = 0
+        self.cache_ttl = cache_ttl
+        # Verified passwords are remembered by a salted hash, never in clear
+        self.salt = secrets.token_bytes(16)
+        self.verified: Dict[bytes, float] = {}
+
+    def _digest(self, password: str) -> bytes:
+        return hashlib.sha256(self.salt + password.encode("utf-8")).digest()
+
+    async def verify(self, password: str) -> bool:
+        digest = self._digest(password)
+        now = time.time()
+        if self.verified.get(digest, 0) > now:
+            return True
+        if self.pending >= self.max_pending:
+            raise VerifierBusy()
+        self.pending += 1
+        try:
+            valid = await asyncio.get_running_loop().run_in_executor(
+                self.pool, verify_password, password, self.password_hash
+            )
+        finally:
+            self.pending -= 1
+        if valid:
+            self.verified = {
+                key: expires for key, expires in self.verified.items() if expires > now
+            }
+            self.verified[digest] = now + self.cache_ttl
+        return valid
+
+
+class RateLimiter:
+    """Token buckets per client, refilled at rate tokens per second up to burst."""
+
+    def __init__(self, rate: float, burst: int, max_clients: int = 10000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets: OrderedDict[str, tuple] = OrderedDict()
+
+    def allow(self, client: str) -> bool:
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[client] = (tokens - 1 if allowed else tokens, now)
+        # Clients idle for long are back to a full bucket anyway
+        while len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return allowed
+
+
+class RevocationStore:
+    """Ids of revoked tokens, kept in SQLite until the tokens expire anyway.
+
+    Several server processes can share the same file, the revoked ids are
+    reloaded in memory only when another connection changed them.
+    """
+
+    def __init__(self, path: str, prune_interval: float = 3600) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS revoked (jti TEXT PRIMARY KEY, exp REAL)"
+        )
+        self.lock = threading.Lock()
+        self.prune_interval = prune_interval
+        self.pruned_at = 0.0
+        self.version = None
+        self.revoked: Set[str] = set()
+
+    def _refresh(self) -> None:
+        # data_version changes when another connection commits to the database
+        (version,) = self.db.execute("PRAGMA data_version").fetchone()
+        if version != self.version:
+            self.version = version
+            self.revoked = {
+                jti for (jti,) in self.db.execute("SELECT jti FROM revoked")
+            }
+
+    def _prune(self) -> None:
+        now = time.time()
+        if now - self.pruned_at < self.prune_interval:
+            return
+        self.pruned_at = now
+        self.db.execute("DELETE FROM revoked WHERE exp < ?", (now,))
+        self.version = None
+
+    def revoke(self, jti: str, exp: float) -> None:
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO revoked VALUES (?, ?)", (jti, exp))
+            self.revoked.add(jti)
+            self._prune()
+
+    def is_revoked(self, jti: str) -> bool:
+        with self.lock:
+            self._prune()
+            self._refresh()
+            return jti in self.revoked
+
+
+class TokenVerifier:
+    """Verifies JWTs, remembering the claims of recently verified tokens until they expire."""
+
+    def __init__(
+        self, secret_key: str, revocations: RevocationStore, cache_size: int = 1024
+    ) -> None:
+        self.secret_key = secret_key
+        self.revocations = revocations
+        self.cache_size = cache_size
+        self.cache: OrderedDict[bytes, Dict[str, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def token_id(token: str, claims: Dict[str, Any]) -> str:
+        # Tokens issued without an id are revoked by their hash
+        return claims.get("jti") or hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        """Claims of a valid token, None when it is invalid, expired or revoked."""
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        with self.lock:
+            claims = self.cache.get(key)
+            if claims is not None:
+                self.cache.move_to_end(key)
+        if claims is None:
+            try:
+                claims = jwt.decode(token, self.secret_key, algorithms="HS256")
+            except jwt.InvalidTokenError:
+                return None
+            with self.lock:
+                self.cache[key] = claims
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        elif claims.get("exp", float("inf")) <= time.time():
+            with self.lock:
+                self.cache.pop(key, None)
+            return None
+        if self.revocations.is_revoked(self.token_id(token, claims)):
+            return None
+        return claims
+
+    def revoke(self, token: str, claims: Dict[str, Any]) -> None:
+        self.revocations.revoke(
+            self.token_id(token, claims), claims.get("exp", time.time() + 365 * 86400)
+        )
+
+
+def build_password_verifier(config: dict[str, Any]) -> PasswordVerifier:
+    server = config["server"]
+    return PasswordVerifier(
+        hash_password(server["password"]),
+        server.get("password_workers", 2),
+        server.get("password_queue", 8),
+        server.get("password_cache_ttl", 300),
+    )
+
+
+def build_login_limiter(config: dict[str, Any]) -> RateLimiter:
+    return RateLimiter(
+        config["server"].get("login_rate", 0.2), config["server"].get("login_burst", 5)
+    )
+
+
+def build_revocation_store(config: dict[str, Any]) -> RevocationStore:
+    return RevocationStore(
+        config["server"].get("revocation_path", "data/revoked_tokens.sqlite")
+    )
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from tools.executor import run_in
+
+# Events of a job kept for its subscribers, tokens are only streamed by /ask_stream
+RECORDED_EVENTS = {"action", "observation", "tool_output", "final", "error"}
+# Events ending a step of the agent, the events recorded so far are written with them
+STEP_EVENTS = {"observation", "final", "error"}
+# Seconds the output of a running tool can wait before being written
+FLUSH_INTERVAL = 1.0
+
+
+class JobQueue:
+    """Questions answered in the background, persisted in SQLite.
+
+    Every server process runs a few workers claiming the queued jobs by
+    priority, so a job survives the connection that submitted it and is
+    never run by two processes. Jobs finished for longer than ttl seconds
+    are deleted, and jobs whose process died while running them are marked
+    failed rather than run twice, since they may already have acted. The
+    events and results of the jobs are written from a thread of their own,
+    the events once per step of the agent.
+    """
+
+    def __init__(
+        self, path: str, workers: int = 2, timeout: float = 900, ttl: float = 86400
+    ) -> None:
+        self.size = workers
+        self.timeout = timeout
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cleaned_at = 0.0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.workers: List[asyncio.Task] = []
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="j4rvis-jobs")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, conversation TEXT, input TEXT, no_cache INTEGER, "
+            "priority INTEGER, status TEXT, result TEXT, error TEXT, "
+            "created REAL, started REAL, finished REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS job_events ("
+            "job TEXT, seq INTEGER, event TEXT, PRIMARY KEY (job, seq))"
+        )
+        self.db.commit()
+
+    def submit(
+        self, conversation: str, input: str, priority: int = 0, no_cache: bool = False
+    ) -> str:
+        id = uuid4().hex
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, 'queued', NULL, NULL, ?, NULL, NULL)",
+                (id, conversation, input, int(no_cache), priority, time.time()),
+            )
+            self.db.commit()
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return id
+
+    def get(self, id: str, conversation: str) -> Optional[Dict[str, Any]]:
+        """A job, only to the conversation that submitted it."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT input, priority, status, result, error, created, started, finished "
+                "FROM jobs WHERE id = ? AND conversation = ?",
+                (id, conversation),
+            ).fetchone()
+        if row is None:
+            return None
+        input, priority, status, result, error, created, started, finished = row
+        return {
+            "id": id,
+            "input": input,
+            "priority": priority,
+            "status": status,
+            "result": result,
+            "error": error,
+            "created": created,
+            "started": started,
+            "finished": finished,
+        }
+
+    def events(self, id: str, after: int = 0) -> List[Tuple[int, Dict[str, Any]]]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT seq, event FROM job_events WHERE job = ? AND seq > ? ORDER BY seq",
+                (id, after),
+            ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def _cleanup(self) -> None:
+        now = time.time()
+        if now - self.cleaned_at < 60:
+            return
+        self.cleaned_at = now
+        self.db.execute(
+            "UPDATE jobs SET status = 'failed', error = 'interrupted', finished = ? "
+            "WHERE status = 'running' AND started < ?",
+            (now, now - self.timeout - 60),
+        )
+        self.db.execute(
+            "DELETE FROM job_events WHERE job IN "
+            "(SELECT id FROM jobs WHERE finished < ?)",
+            (now - self.ttl,),
+        )
+        self.db.execute("DELETE FROM jobs WHERE finished < ?", (now - self.ttl,))
+
+    def _claim(self) -> Optional[Tuple[str, str, str, bool]]:
+        with self.lock:
+            self._cleanup()
+            row = self.db.execute(
+                "SELECT id, conversation, input, no_cache FROM jobs WHERE status = 'queued' "
+                "ORDER BY priority DESC, created LIMIT 1"
+            ).fetchone()
+            claimed = (
+                row is not None
+                and self.db.execute(
+                    "UPDATE jobs SET status = 'running', started = ? "
+                    "WHERE id = ? AND status = 'queued'",
+                    (time.time(), row[0]),
+                ).rowcount
+            )
+            self.db.commit()
+        if not claimed:
+            return None
+        id, conversation, input, no_cache = row
+        return id, conversation, input, bool(no_cache)
+
+    def _record(self, id: str, events: List[Tuple[int, Dict[str, Any]]]) -> None:
+        with self.lock:
+            # A write cancelled by the job timeout may still have happened, it is not repeated
+            self.db.executemany(
+                "INSERT OR IGNORE INTO job_events VALUES (?, ?, ?)",
+                [(id, seq, json.dumps(event)) for seq, event in events],
+            )
+            self.db.commit()
+
+    def _finish(
+        self, id: str, status: str, result: Optional[str], error: Optional[str]
+    ) -> None:
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+                (status, result, error, time.time(), id),
+            )
+            self.db.commit()
+
+    async def _run_job(
+        self,
+        job: Tuple[str, str, str, bool],
+        run: Callable[..., AsyncIterator[Dict[str, Any]]],
+    ) -> None:
+        id, conversation, input, no_cache = job
+        result, error, seq = None, None, 0
+        pending: List[Tuple[int, Dict[str, Any]]] = []
+        flushed_at = time.monotonic()
+
+        async def flush() -> None:
+            nonlocal flushed_at
+            if pending:
+                events = pending[:]
+                await run_in(self.pool, self._record, id, events)
+                del pending[: len(events)]
+            flushed_at = time.monotonic()
+
+        async def consume() -> None:
+            nonlocal result, error, seq
+            async for event in run(conversation, input, no_cache):
+                if event["type"] not in RECORDED_EVENTS:
+                    continue
+                seq += 1
+                pending.append((seq, event))
+                if (
+                    event["type"] in STEP_EVENTS
+                    or time.monotonic() - flushed_at > FLUSH_INTERVAL
+                ):
+                    await flush()
+                if event["type"] == "final":
+                    result = event["content"]
+                elif event["type"] == "error":
+                    error = event["content"]
+
+        try:
+            await asyncio.wait_for(consume(), self.timeout)
+        except asyncio.TimeoutError:
+            error = f"the job took more than {self.timeout} seconds"
+        except asyncio.CancelledError:
+            # The server is stopping
+            self._record(id, pending)
+            self._finish(id, "failed", None, "interrupted")
+            raise
+        except Exception:
+            traceback.print_exc()
+            error = "the job failed"
+        # Events of a job stopped in the middle of a step
+        await flush()
+        if result is not None:
+            await run_in(self.pool, self._finish, id, "done", result, None)
+        else:
+            await run_in(
+                self.pool, self._finish, id, "failed", None, error or "the job failed"
+            )
+
+    async def _work(self, run: Callable[..., AsyncIterator[Dict[str, Any]]]) -> None:
+        while True:
+            job = self._claim()
+            if job is None:
+                # Jobs submitted to other processes are noticed by polling
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            await self._run_job(job, run)
+
+    def start(self, run: Callable[..., AsyncIterator[Dict[str, Any]]]) -> None:
+        """Start the workers, run(conversation, input, no_cache) yields the events of a job."""
+        self.wakeup = asyncio.Event()
+        self.workers = [asyncio.create_task(self._work(run)) for _ in range(self.size)]
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.pool.shutdown()
+
+
+def build_job_queue(config: dict[str, Any]) -> Optional[JobQueue]:
+    jobs = config.get("jobs", {})
+    if not jobs.get("enabled", True):
+        return None
+    return JobQueue(
+        jobs.get("path", "data/jobs.sqlite"),
+        jobs.get("workers", 2),
+        jobs.get("timeout", 900),
+        jobs.get("ttl", 86400),
+    )
@@ -0,0 +1,225 @@
+import os
+import json
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakValueDictionary
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+from langchain import LLMChain, PromptTemplate
+from langchain.chat_models import ChatOpenAI
+from tools.budget import TokenBudget
+from tools.executor import run_in
+
+summary_prompt = PromptTemplate(
+    template=(
+        "Progressively summarize the conversation between a user and Jarvis, their personal "
+        "assistant, adding the new lines to the current summary. Keep names, dates, amounts, "
+        "email addresses, file paths, document ids and decisions, drop small talk.\n\n"
+        "Current summary:\n{summary}\n\n"
+        "New lines of conversation:\n{lines}\n\n"
+        "New summary:"
+    ),
+    input_variables=["summary", "lines"],
+)
+
+
+def format_turns(turns: List[Tuple[str, str]]) -> str:
+    return "\n".join(
+        f"User: {question}\nJarvis: {answer}" for question, answer in turns
+    )
+
+
+class Conversation:
+    def __init__(self, summary: str = "", turns: List[Tuple[str, str]] = None) -> None:
+        self.summary = summary
+        self.turns = turns or []
+
+
+class ConversationMemory:
+    """Recent turns of each conversation verbatim, older ones folded into a rolling summary.
+
+    Active conversations stay in an LRU in memory, the least recently used ones are
+    only kept in SQLite and loaded back when their user asks again. The LRU is
+    dropped when another server process wrote to the database, and every change
+    is applied to the row read in the same transaction, so a process never
+    overwrites the turns another one added. The database is only used from the
+    memory's own threads, a transaction waiting for another process never
+    blocks the event loop.
+    """
+
+    def __init__(
+        self,
+        budget: TokenBudget,
+        summarize: Callable[[str, str], Awaitable[str]],
+        path: str,
+        max_turns: int = 6,
+        max_tokens: int = 1500,
+        summary_tokens: int = 400,
+        max_active: int = 256,
+    ) -> None:
+        self.budget = budget
+        self.summarize = summarize
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.max_active = max_active
+        self.active: OrderedDict[str, Conversation] = OrderedDict()
+        self.lock = threading.Lock()
+        # Turns of the same conversation are folded one after the other
+        self.folding: WeakValueDictionary[str, asyncio.Lock] = WeakValueDictionary()
+        self.pool = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="j4rvis-memory"
+        )
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Shared by the server processes, a busy database is waited for
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "id TEXT PRIMARY KEY, summary TEXT, turns TEXT)"
+        )
+        self.db.commit()
+        self.version = None
+
+    def _load(self, id: str) -> Conversation:
+        row = self.db.execute(
+            "SELECT summary, turns FROM conversations WHERE id = ?", (id,)
+        ).fetchone()
+        if row is None:
+            return Conversation()
+        return Conversation(row[0], [tuple(turn) for turn in json.loads(row[1])])
+
+    def _keep(self, id: str, conversation: Conversation) -> None:
+        self.active[id] = conversation
+        self.active.move_to_end(id)
+        # The evicted conversations are already on disk
+        while len(self.active) > self.max_active:
+            self.active.popitem(last=False)
+
+    def _get(self, id: str) -> Conversation:
+        with self.lock:
+            # data_version changes when another connection commits to the database
+            (version,) = self.db.execute("PRAGMA data_version").fetchone()
+            if version != self.version:
+                self.version = version
+                self.active.clear()
+            conversation = self.active.get(id)
+            if conversation is None:
+                conversation = self._load(id)
+            self._keep(id, conversation)
+            return conversation
+
+    def _update(self, id: str, change: Callable[[Conversation], bool]) -> None:
+        """Apply change to the stored conversation, it returns False to leave it as is."""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                conversation = self._load(id)
+                if change(conversation):
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                        (id, conversation.summary, json.dumps(conversation.turns)),
+                    )
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+            self._keep(id, conversation)
+
+    def _to_fold(self, turns: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        count = 0
+        while len(turns) - count > self.max_turns or (
+            len(turns) - count > 1
+            and self.budget.count(format_turns(turns[count:])) > self.max_tokens
+        ):
+            count += 1
+        return turns[:count]
+
+    async def history(self, id: str) -> str:
+        """The conversation so far, as it is shown to the agent."""
+        conversation = await run_in(self.pool, self._get, id)
+        if not conversation.summary and not conversation.turns:
+            return ""
+        history = "\nPrevious conversation:\n"
+        if conversation.summary:
+            history += f"Summary of the earlier turns: {conversation.summary}\n"
+        return history + format_turns(conversation.turns) + "\n"
+
+    async def add_turn(self, id: str, question: str, answer: str) -> None:
+        """Add a turn verbatim, fold() summarizes the turns it pushes out of the window."""
+        # A single long turn must not take the whole budget
+        half = self.max_tokens // 2
+        turn = (
+            self.budget.truncate(question, half),
+            self.budget.truncate(answer, half),
+        )
+
+        def append(conversation: Conversation) -> bool:
+            conversation.turns.append(turn)
+            return True
+
+        await run_in(self.pool, self._update, id, append)
+
+    async def fold(self, id: str) -> None:
+        lock = self.folding.get(id)
+        if lock is None:
+            lock = self.folding[id] = asyncio.Lock()
+        async with lock:
+            conversation = await run_in(self.pool, self._get, id)
+            folded = self._to_fold(conversation.turns)
+            if not folded:
+                return
+            summary = await self.summarize(conversation.summary, format_turns(folded))
+            summary = self.budget.truncate(summary.strip(), self.summary_tokens)
+
+            def replace(current: Conversation) -> bool:
+                # Another process folded them first, or the conversation was forgotten
+                if (
+                    current.summary != conversation.summary
+                    or current.turns[: len(folded)] != folded
+                ):
+                    return False
+                current.summary = summary
+                del current.turns[: len(folded)]
+                return True
+
+            await run_in(self.pool, self._update, id, replace)
+
+    def _forget(self, id: str) -> None:
+        with self.lock:
+            self.active.pop(id, None)
+            self.db.execute("DELETE FROM conversations WHERE id = ?", (id,))
+            self.db.commit()
+
+    async def forget(self, id: str) -> None:
+        await run_in(self.pool, self._forget, id)
+
+
+def build_conversation_memory(
+    config: dict[str, Any], budget: TokenBudget
+) -> Optional[ConversationMemory]:
+    memory = config.get("memory", {})
+    if not memory.get("enabled", True):
+        return None
+    summary_chain = LLMChain(
+        llm=ChatOpenAI(
+            model_name=memory.get("summary_model", "gpt-3.5-turbo"), temperature=0
+        ),
+        prompt=summary_prompt,
+    )
+
+    async def summarize(summary: str, lines: str) -> str:
+        return await summary_chain.arun(summary=summary or "(empty)", lines=lines)
+
+    return ConversationMemory(
+        budget,
+        summarize,
+        memory.get("path", "data/memory.sqlite"),
+        memory.get("max_turns", 6),
+        memory.get("max_tokens", 1500),
+        memory.get("summary_tokens", 400),
+        memory.get("max_active", 256),
+    )
@@ -9,6 +9,18 @@ def get_j4rvis_template(conf: dict[str, Any]):
     employer_siret = conf["employer"]["siret"]
     employer_bank_name = conf["employer"]["bank_name"]
     employer_iban = conf["employer"]["iban"]
+    multi_action = (
+        """
+When several independent actions are needed, take them at once by numbering them:
+Action 1: the first action to take
+Action 1 Input: the input to the first action
+Action 2: the second action to take
+Action 2 Input: the input to the second action
+Their observations come back numbered in the same order.
+"""
+        if conf.get("agent", {}).get("multi_action", True)
+        else ""
+    )
     return (
         f"As {employer_name}'s GPT-4 based intelligent personal assistant "
         "called Jarvis and modeled after Tony Stark's assistant in the Iron Man movie, "
@@ -32,9 +44,11 @@ Observation: the result of the action
 ... (this Thought/Action/Action Input/Observation can repeat N times)
 Thought: I now know the final answer
 Final Answer: the final answer to the original input question, markdown is supported
-
+"""
+        + multi_action
+        + """
 Begin!
-
+{history}
 Question: {input}
 {agent_scratchpad}"
 )
@@ -0,0 +1,189 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Callable, List, Optional, Set, Tuple
+import faiss
+import numpy as np
+from langchain.schema import AgentAction
+
+# Questions whose answer depends on when they are asked
+TIME_SENSITIVE = re.compile(
+    r"\b(now|today|tonight|tomorrow|yesterday|this (week|month|year)|next|last|"
+    r"latest|current|currently|recent|weather|news|calendar|schedule|agenda)\b",
+    re.IGNORECASE,
+)
+
+# Questions asking the agent to act rather than to answer
+SIDE_EFFECTS = re.compile(
+    r"\b(send|email|mail|create|add|book|invite|cancel|delete|remove|generate|"
+    r"write|pdf|run|execute)\b",
+    re.IGNORECASE,
+)
+
+# Answers produced with these tools are never reused, they act or depend on the moment
+SIDE_EFFECT_TOOLS = {
+    "Email Sender",
+    "Email Status",
+    "Calendar",
+    "Terminal",
+    "Python REPL",
+    "Document Generator",
+    "HTML to PDF",
+}
+
+
+class HashingEmbedder:
+    """Local stand-in embedder hashing words into a fixed size vector, works offline."""
+
+    def __init__(self, dim: int = 512) -> None:
+        self.dim = dim
+
+    def __call__(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dim] += 1.0
+        return vector
+
+
+class SemanticCache:
+    """Final answers of past questions, searched by similarity of the question embedding.
+
+    The questions, answers and embeddings are kept in SQLite so the FAISS index
+    can be rebuilt when the server starts. Every server process keeps its own
+    index, caught up with the answers the others added or evicted when the
+    database changed.
+    """
+
+    def __init__(
+        self,
+        embedder: Callable[[str], List[float]],
+        path: str,
+        threshold: float = 0.95,
+        max_entries: int = 5000,
+    ) -> None:
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.index = None
+        # Ids in the index, and the last one loaded from the database
+        self.ids: Set[int] = set()
+        self.loaded = 0
+        self.version = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Shared by the server processes, a busy database is waited for
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, question TEXT, answer TEXT, vector BLOB)"
+        )
+        self.db.commit()
+        with self.lock:
+            self._sync()
+
+    def _index_add(self, id: int, vector: np.ndarray) -> None:
+        if self.index is None:
+            self.index = faiss.IndexIDMap(faiss.IndexFlatIP(vector.shape[1]))
+        self.index.add_with_ids(vector, np.array([id], dtype="int64"))
+        self.ids.add(id)
+
+    def _index_remove(self, ids: List[int]) -> None:
+        if ids:
+            self.index.remove_ids(np.array(ids, dtype="int64"))
+            self.ids.difference_update(ids)
+
+    def _sync(self) -> None:
+        # data_version changes when another connection commits to the database
+        (version,) = self.db.execute("PRAGMA data_version").fetchone()
+        if version == self.version:
+            return
+        self.version = version
+        for id, vector in self.db.execute(
+            "SELECT id, vector FROM answers WHERE id > ?", (self.loaded,)
+        ).fetchall():
+            self.loaded = max(self.loaded, id)
+            if id not in self.ids:
+                self._index_add(
+                    id, np.frombuffer(vector, dtype="float32").reshape(1, -1)
+                )
+        # Answers are evicted oldest first, by whichever process adds one
+        (oldest,) = self.db.execute("SELECT MIN(id) FROM answers").fetchone()
+        self._index_remove([id for id in self.ids if oldest is None or id < oldest])
+
+    def cacheable(self, question: str) -> bool:
+        return not TIME_SENSITIVE.search(question) and not SIDE_EFFECTS.search(question)
+
+    def reusable(self, intermediate_steps: List[Tuple[AgentAction, str]]) -> bool:
+        return all(
+            action.tool not in SIDE_EFFECT_TOOLS for action, _ in intermediate_steps
+        )
+
+    def embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embedder(question), dtype="float32").reshape(1, -1)
+        # Normalized vectors make the inner product a cosine similarity
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, vector: np.ndarray) -> Optional[str]:
+        with self.lock:
+            self._sync()
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            # The closest answers may have been evicted since the last sync
+            scores, ids = self.index.search(vector, min(4, self.index.ntotal))
+            for score, id in zip(scores[0], ids[0]):
+                if id == -1 or score < self.threshold:
+                    return None
+                row = self.db.execute(
+                    "SELECT answer FROM answers WHERE id = ?", (int(id),)
+                ).fetchone()
+                if row is not None:
+                    return row[0]
+        return None
+
+    def add(self, question: str, answer: str, vector: np.ndarray) -> None:
+        with self.lock:
+            self._sync()
+            cursor = self.db.execute(
+                "INSERT INTO answers (question, answer, vector) VALUES (?, ?, ?)",
+                (question, answer, vector.tobytes()),
+            )
+            self._index_add(cursor.lastrowid, vector)
+            # Forget the oldest answers beyond max_entries
+            (count,) = self.db.execute("SELECT COUNT(*) FROM answers").fetchone()
+            if count > self.max_entries:
+                old_ids = [
+                    id
+                    for (id,) in self.db.execute(
+                        "SELECT id FROM answers ORDER BY id LIMIT ?",
+                        (count - self.max_entries,),
+                    )
+                ]
+                self.db.executemany(
+                    "DELETE FROM answers WHERE id = ?", [(id,) for id in old_ids]
+                )
+                self._index_remove([id for id in old_ids if id in self.ids])
+            self.db.commit()
+
+
+def build_semantic_cache(config: dict[str, Any]) -> Optional[SemanticCache]:
+    semantic_cache = config.get("semantic_cache", {})
+    if not semantic_cache.get("enabled", False):
+        return None
+    if semantic_cache.get("embedder", "openai") == "hashing":
+        embedder = HashingEmbedder()
+    else:
+        from langchain.embeddings import OpenAIEmbeddings
+
+        embedder = OpenAIEmbeddings().embed_query
+    return SemanticCache(
+        embedder,
+        semantic_cache.get("path", "data/semantic_cache.sqlite"),
+        semantic_cache.get("threshold", 0.95),
+        semantic_cache.get("max_entries", 5000),
+    )
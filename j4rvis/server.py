@@ -1,18 +1,37 @@
 from langchain.agents import AgentExecutor
-from auth import verify_password
+from auth import (
+    PasswordVerifier,
+    RateLimiter,
+    RevocationStore,
+    TokenVerifier,
+    VerifierBusy,
+)
+from streaming import stream_agent
+from tools.budget import TokenBudget
+from tools.llm_cache import cache_bypass, get_cache
+from tools.executor import run_blocking
+from tools.email_queue import get_email_queue
+from tools.session import session_id
+from semantic_cache import SemanticCache
+from memory import ConversationMemory
+from jobs import JobQueue
+from typing import Any, Dict, List, Optional, Sequence, Set
 from aiohttp import web
 import aiohttp_cors
 import jwt
 import traceback
 import secrets
 import datetime
+import hashlib
+import asyncio
+import ipaddress
+import json
+import uuid
+import os
 
-# Secret key to sign JWT tokens
+# Secret key to sign JWT tokens, when the config does not set one
 SECRET_KEY = secrets.token_hex(32)
 
-# JWT blacklist set
-jwt_blacklist = set()
-
 
 # JWT token validation decorator
 def check_jwt(handler):
@@ -20,40 +39,189 @@ def check_jwt(handler):
         token = request.headers.get("Authorization", None)
         if not token:
             return web.json_response({"error": "Missing Authorization header"})
-        try:
-            _ = jwt.decode(token, SECRET_KEY, algorithms="HS256")
-            if token in jwt_blacklist:
-                return web.json_response({"error": "Invalid JWT token"})
-        except jwt.InvalidTokenError:
+        claims = self.tokens.verify(token)
+        if claims is None:
             return web.json_response({"error": "Invalid JWT token"})
+        request["jwt"] = claims
         return await handler(self, request)
 
     return middleware_handler
 
 
+def conversation_id(request) -> str:
+    """Conversations are kept per JWT, identified without storing the token itself."""
+    token = request.headers.get("Authorization", "")
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+def client_address(request, trusted_proxies: List[Any]) -> str:
+    """Address of the client, as forwarded by the proxies trusted to tell it."""
+
+    def trusted(address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address.strip())
+        except ValueError:
+            return False
+        return any(ip in network for network in trusted_proxies)
+
+    address = request.remote or ""
+    if not trusted(address):
+        return address
+    # Each proxy appends the address it got the request from, the first one
+    # from the right that is not a trusted proxy is the client
+    forwarded = request.headers.get("X-Forwarded-For", "")
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    if not hops and request.headers.get("X-Real-IP"):
+        hops = [request.headers["X-Real-IP"].strip()]
+    for hop in reversed(hops):
+        address = hop
+        if not trusted(hop):
+            break
+    return address
+
+
 class WebServer:
-    def __init__(self, agent: AgentExecutor, password_hash: bytes) -> None:
+    def __init__(
+        self,
+        agent: AgentExecutor,
+        password_verifier: PasswordVerifier,
+        budget: TokenBudget,
+        max_concurrency: int = 4,
+        semantic_cache: Optional[SemanticCache] = None,
+        memory: Optional[ConversationMemory] = None,
+        revocations: Optional[RevocationStore] = None,
+        login_limiter: Optional[RateLimiter] = None,
+        secret_key: Optional[str] = None,
+        jobs: Optional[JobQueue] = None,
+        batch_parallelism: int = 4,
+        batch_concurrency: int = 8,
+        max_batch_size: int = 50,
+        trusted_proxies: Sequence[str] = (),
+    ) -> None:
         self.agent = agent
-        self.password_hash = password_hash
+        self.password_verifier = password_verifier
+        self.login_limiter = login_limiter or RateLimiter(0.2, 5)
+        self.trusted_proxies = [
+            ipaddress.ip_network(proxy, strict=False) for proxy in trusted_proxies
+        ]
+        self.budget = budget
+        self.semantic_cache = semantic_cache
+        self.memory = memory
+        # Summarizations running after their answer was sent
+        self.folding: Set[asyncio.Task] = set()
+        self.jobs = jobs
+        self.secret_key = secret_key or SECRET_KEY
+        self.tokens = TokenVerifier(
+            self.secret_key,
+            revocations or RevocationStore("data/revoked_tokens.sqlite"),
+        )
+        # Bounds how many questions the agent works on at the same time
+        self.agent_slots = asyncio.Semaphore(max_concurrency)
+        # Questions of all the batches are bounded apart from interactive ones
+        self.batch_slots = asyncio.Semaphore(batch_concurrency)
+        self.batch_parallelism = batch_parallelism
+        self.max_batch_size = max_batch_size
 
     async def create_token(self, request):
+        # Each attempt costs a bcrypt verification, bound them per client
+        if not self.login_limiter.allow(client_address(request, self.trusted_proxies)):
+            return web.json_response({"error": "too many attempts, retry later"})
         data = await request.json()
         password = data.get("password", None)
-        if verify_password(password, self.password_hash):
+        if not isinstance(password, str):
+            return web.json_response({"error": "unable to verify password"})
+        try:
+            valid = await self.password_verifier.verify(password)
+        except VerifierBusy:
+            return web.json_response({"error": "too many attempts, retry later"})
+        if valid:
             payload = {
                 "exp": datetime.datetime.utcnow() + datetime.timedelta(days=365),
+                # Identifies the token in the revocation store
+                "jti": uuid.uuid4().hex,
             }
-            token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+            token = jwt.encode(payload, self.secret_key, algorithm="HS256")
             return web.json_response({"token": token})
         else:
             return web.json_response({"error": "unable to verify password"})
 
+    async def remember(self, conversation: str, question: str, answer: str) -> None:
+        """Add a turn to the history, the older turns are summarized after responding."""
+        if self.memory is None:
+            return
+        try:
+            await self.memory.add_turn(conversation, question, answer)
+        except Exception:
+            # Losing a turn of history must not fail the answer
+            traceback.print_exc()
+            return
+        task = asyncio.create_task(self.fold(conversation))
+        self.folding.add(task)
+        task.add_done_callback(self.folding.discard)
+
+    async def fold(self, conversation: str) -> None:
+        try:
+            await self.memory.fold(conversation)
+        except Exception:
+            traceback.print_exc()
+
+    async def finish_folding(self, app):
+        # Summaries being written are saved before the process exits
+        await asyncio.gather(*self.folding, return_exceptions=True)
+
     @check_jwt
     async def invalidate_token(self, request):
         token = request.headers.get("Authorization", None)
-        jwt_blacklist.add(token)
+        self.tokens.revoke(token, request["jwt"])
+        if self.memory is not None:
+            await self.memory.forget(conversation_id(request))
         return web.json_response({"status": "Token invalidated"})
 
+    async def answer(
+        self, question: str, history: str, no_cache: bool, slots: asyncio.Semaphore
+    ) -> Dict[str, Any]:
+        """Answer a question from the semantic cache or with the agent, as /ask responds."""
+        # Answer from a similar past question when it is safe to reuse,
+        # follow-up questions depend on the conversation so they never are
+        vector = None
+        if (
+            self.semantic_cache
+            and not no_cache
+            and not history
+            and self.semantic_cache.cacheable(question)
+        ):
+            vector = await run_blocking(self.semantic_cache.embed, question)
+            cached = await run_blocking(self.semantic_cache.lookup, vector)
+            if cached is not None:
+                return {
+                    "content": cached,
+                    "bot": True,
+                    "metadata": {"semantic_cache": True},
+                }
+
+        # Run the agent using the question
+        async with slots:
+            result = await self.agent.acall({"input": question, "history": history})
+        if vector is not None and self.semantic_cache.reusable(
+            result["intermediate_steps"]
+        ):
+            await run_blocking(
+                self.semantic_cache.add, question, result["output"], vector
+            )
+
+        # Prepare the JSON response
+        steps = self.budget.describe_steps(result["intermediate_steps"])
+        return {
+            "content": result["output"],
+            "bot": True,
+            "metadata": {
+                "steps": steps,
+                "total_tokens": sum(
+                    step["action_tokens"] + step["observation_tokens"] for step in steps
+                ),
+            },
+        }
+
     @check_jwt
     async def ask(self, request):
         # Read the JSON body of the request
@@ -61,13 +229,18 @@ class WebServer:
         input_question = data.get("input", None)
         if not input_question:
             return web.json_response({"error": "invalid input or empty question"})
+        no_cache = bool(data.get("no_cache", False))
+        cache_bypass.set(no_cache)
+        # Tools keep their workspace and REPL state for the whole conversation
+        conversation = conversation_id(request)
+        session_id.set(conversation)
+        history = await self.memory.history(conversation) if self.memory else ""
 
         try:
-            # Run the agent using the input_question
-            result = self.agent.run(input_question)
-
-            # Prepare the JSON response
-            response_data = {"content": result, "bot": True}
+            response_data = await self.answer(
+                input_question, history, no_cache, self.agent_slots
+            )
+            await self.remember(conversation, input_question, response_data["content"])
 
             # Return the JSON response
             return web.json_response(response_data)
@@ -76,6 +249,208 @@ class WebServer:
             traceback.print_exc()
             return web.json_response({"error": "an attribute error happened"})
 
+    @check_jwt
+    async def ask_stream(self, request):
+        data = await request.json()
+        input_question = data.get("input", None)
+        if not input_question:
+            return web.json_response({"error": "invalid input or empty question"})
+        cache_bypass.set(bool(data.get("no_cache", False)))
+        conversation = conversation_id(request)
+        session_id.set(conversation)
+        history = await self.memory.history(conversation) if self.memory else ""
+
+        # Send the headers right away so the client gets its first byte early
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        answer = None
+        async with self.agent_slots:
+            async for event in stream_agent(
+                self.agent, {"input": input_question, "history": history}
+            ):
+                if event["type"] == "final":
+                    answer = event["content"]
+                await response.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        if answer is not None:
+            await self.remember(conversation, input_question, answer)
+        await response.write_eof()
+        return response
+
+    async def run_job(self, conversation: str, question: str, no_cache: bool):
+        """Events of a background job, answered like /ask_stream."""
+        cache_bypass.set(no_cache)
+        session_id.set(conversation)
+        history = await self.memory.history(conversation) if self.memory else ""
+        answer = None
+        async for event in stream_agent(
+            self.agent, {"input": question, "history": history}
+        ):
+            if event["type"] == "final":
+                answer = event["content"]
+            yield event
+        if answer is not None:
+            await self.remember(conversation, question, answer)
+
+    async def start_jobs(self, app):
+        # Jobs have their own workers, they never take the slots of interactive questions
+        self.jobs.start(self.run_job)
+
+    async def stop_jobs(self, app):
+        await self.jobs.stop()
+
+    @check_jwt
+    async def submit_job(self, request):
+        data = await request.json()
+        input_question = data.get("input", None)
+        if not input_question:
+            return web.json_response({"error": "invalid input or empty question"})
+        priority = data.get("priority", 0)
+        if not isinstance(priority, int):
+            return web.json_response({"error": "priority must be an integer"})
+        job_id = self.jobs.submit(
+            conversation_id(request),
+            input_question,
+            priority,
+            bool(data.get("no_cache", False)),
+        )
+        return web.json_response({"job": job_id, "status": "queued"})
+
+    @check_jwt
+    async def job_status(self, request):
+        job = self.jobs.get(request.match_info["id"], conversation_id(request))
+        if job is None:
+            return web.json_response({"error": "unknown job"})
+        del job["result"]
+        return web.json_response(job)
+
+    @check_jwt
+    async def job_result(self, request):
+        job = self.jobs.get(request.match_info["id"], conversation_id(request))
+        if job is None:
+            return web.json_response({"error": "unknown job"})
+        if job["status"] == "done":
+            return web.json_response(
+                {"content": job["result"], "bot": True, "metadata": {"job": job["id"]}}
+            )
+        if job["status"] == "failed":
+            return web.json_response({"error": job["error"]})
+        return web.json_response({"error": "job not finished", "status": job["status"]})
+
+    @check_jwt
+    async def job_events(self, request):
+        job_id = request.match_info["id"]
+        conversation = conversation_id(request)
+        if self.jobs.get(job_id, conversation) is None:
+            return web.json_response({"error": "unknown job"})
+        # Reconnecting clients resume after the last event they got
+        after = request.headers.get("Last-Event-ID", request.query.get("after", "0"))
+        after = int(after) if after.isdigit() else 0
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        finished = False
+        while True:
+            # The job may run in another process, its events are read from the queue
+            for seq, event in self.jobs.events(job_id, after):
+                after = seq
+                await response.write(
+                    f"id: {seq}\ndata: {json.dumps(event)}\n\n".encode("utf-8")
+                )
+            if finished:
+                break
+            # One more read once finished, for the events recorded just before,
+            # a job deleted by the TTL meanwhile ends the stream too
+            job = self.jobs.get(job_id, conversation)
+            finished = job is None or job["status"] in ("done", "failed")
+            if not finished:
+                await asyncio.sleep(0.5)
+        await response.write_eof()
+        return response
+
+    async def health(self, request):
+        return web.json_response({"status": "ok", "pid": os.getpid()})
+
+    @check_jwt
+    async def ask_batch(self, request):
+        data = await request.json()
+        inputs = data.get("inputs", None)
+        if (
+            not isinstance(inputs, list)
+            or not inputs
+            or not all(isinstance(question, str) and question for question in inputs)
+        ):
+            return web.json_response({"error": "inputs must be a list of questions"})
+        if len(inputs) > self.max_batch_size:
+            return web.json_response(
+                {"error": f"at most {self.max_batch_size} questions per batch"}
+            )
+        no_cache = bool(data.get("no_cache", False))
+        cache_bypass.set(no_cache)
+        conversation = conversation_id(request)
+        parallelism = data.get("parallelism", self.batch_parallelism)
+        if not isinstance(parallelism, int):
+            parallelism = self.batch_parallelism
+        parallel_slots = asyncio.Semaphore(
+            max(1, min(parallelism, self.batch_parallelism))
+        )
+
+        async def answer(question: str, index: int):
+            # Each question gets its own workspace and REPL state, the tasks run in
+            # copies of this context so setting it here stays local to the task
+            session_id.set(f"{conversation}-batch-{index}")
+            async with parallel_slots:
+                try:
+                    # Batched questions are independent, they get no history
+                    return question, await self.answer(
+                        question, "", no_cache, self.batch_slots
+                    )
+                except Exception:
+                    traceback.print_exc()
+                    return question, {"error": "the agent failed"}
+
+        # Identical questions of the batch are answered once
+        indexes: Dict[str, list] = {}
+        for index, question in enumerate(inputs):
+            indexes.setdefault(question, []).append(index)
+        tasks = [
+            asyncio.create_task(answer(question, positions[0]))
+            for question, positions in indexes.items()
+        ]
+
+        # One JSON line per answer, in the order they complete
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            for task in asyncio.as_completed(tasks):
+                question, response_data = await task
+                for index in indexes[question]:
+                    line = {"index": index, "input": question, **response_data}
+                    await response.write((json.dumps(line) + "\n").encode("utf-8"))
+        finally:
+            # The client went away before the end, stop working for it
+            for task in tasks:
+                task.cancel()
+        await response.write_eof()
+        return response
+
+    @check_jwt
+    async def stats(self, request):
+        cache = get_cache()
+        return web.json_response(
+            {"llm_cache": await run_blocking(cache.stats) if cache else None}
+        )
+
+    @check_jwt
+    async def email_status(self, request):
+        status = get_email_queue().status(request.query.get("id", ""))
+        if status is None:
+            return web.json_response({"error": "unknown email id"})
+        return web.json_response(status)
+
     def build_app(self):
         app = web.Application()
         app.add_routes(
@@ -83,8 +458,25 @@ class WebServer:
                 web.post("/create_token", self.create_token),
                 web.post("/invalidate_token", self.invalidate_token),
                 web.post("/ask", self.ask),
+                web.post("/ask_stream", self.ask_stream),
+                web.post("/ask_batch", self.ask_batch),
+                web.get("/stats", self.stats),
+                web.get("/health", self.health),
+                web.get("/email_status", self.email_status),
             ]
         )
+        if self.jobs is not None:
+            app.add_routes(
+                [
+                    web.post("/jobs", self.submit_job),
+                    web.get("/jobs/{id}", self.job_status),
+                    web.get("/jobs/{id}/events", self.job_events),
+                    web.get("/jobs/{id}/result", self.job_result),
+                ]
+            )
+            app.on_startup.append(self.start_jobs)
+            app.on_shutdown.append(self.stop_jobs)
+        app.on_shutdown.append(self.finish_folding)
         cors = aiohttp_cors.setup(
             app,
             defaults={
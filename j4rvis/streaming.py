@@ -0,0 +1,55 @@
+import asyncio
+import traceback
+from typing import Any, AsyncIterator, Dict, Optional
+from langchain.agents import AgentExecutor
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.schema import AgentAction
+from tools.session import event_sink
+
+
+class StreamingCallbackHandler(AsyncCallbackHandler):
+    """Forwards LLM tokens, agent actions and tool observations to a queue."""
+
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue[Optional[Dict[str, Any]]] = asyncio.Queue()
+
+    async def emit(self, event: Optional[Dict[str, Any]]) -> None:
+        await self.queue.put(event)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        await self.emit({"type": "token", "content": token})
+
+    async def on_agent_action(self, action: AgentAction, **kwargs: Any) -> None:
+        await self.emit(
+            {"type": "action", "tool": action.tool, "tool_input": action.tool_input}
+        )
+
+    async def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        await self.emit({"type": "observation", "content": str(output)})
+
+
+async def stream_agent(
+    agent: AgentExecutor, inputs: Dict[str, Any]
+) -> AsyncIterator[Dict[str, Any]]:
+    """Run the agent on its inputs and yield its events as soon as they exist."""
+    handler = StreamingCallbackHandler()
+
+    async def run() -> None:
+        # Lets tools such as the Terminal stream their partial output
+        event_sink.set(handler.emit)
+        try:
+            result = await agent.acall(inputs, callbacks=[handler])
+            await handler.emit({"type": "final", "content": result["output"]})
+        except Exception:
+            traceback.print_exc()
+            await handler.emit({"type": "error", "content": "the agent failed"})
+        finally:
+            await handler.emit(None)
+
+    task = asyncio.create_task(run())
+    try:
+        while (event := await handler.queue.get()) is not None:
+            yield event
+    finally:
+        # The client went away before the end, stop working for it
+        task.cancel()
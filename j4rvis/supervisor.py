@@ -0,0 +1,201 @@
+import os
+import time
+import errno
+import signal
+import select
+import asyncio
+import traceback
+from typing import Callable, Dict, Set
+
+# Written by a worker on its heartbeat pipe
+READY = b"r"
+BEAT = b"h"
+
+
+class Worker:
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.started = time.monotonic()
+        self.beat = self.started
+        self.ready = False
+        # Set once the pipe is closed or the worker was killed, until it is reaped
+        self.gone = False
+
+
+class Supervisor:
+    """Runs the server in several forked workers listening on the same port.
+
+    The workers bind with SO_REUSEPORT so the kernel spreads the connections
+    between them. Each one beats on a pipe from its event loop, a worker that
+    stops beating is killed and replaced. SIGHUP restarts the workers one at a
+    time, an old worker only drains once its replacement is ready.
+    """
+
+    def __init__(
+        self,
+        serve: Callable[[int], None],
+        workers: int,
+        heartbeat_timeout: float = 60,
+        startup_timeout: float = 120,
+        shutdown_timeout: float = 60,
+    ) -> None:
+        # Runs the server in a worker, given the write end of its heartbeat pipe
+        self.serve = serve
+        self.size = workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.startup_timeout = startup_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.workers: Dict[int, Worker] = {}
+        # Workers asked to stop, they are not replaced when they exit
+        self.retiring: Set[int] = set()
+        self.stopping = False
+        self.restarting = False
+        self.spawned_at = 0.0
+
+    def spawn(self) -> int:
+        # Workers crashing at startup are not respawned in a tight loop
+        time.sleep(max(0.0, self.spawned_at + 1 - time.monotonic()))
+        self.spawned_at = time.monotonic()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for fd in [worker.fd for worker in self.workers.values()]:
+                os.close(fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            # Ctrl-C reaches the whole process group, the supervisor stops the workers itself
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                self.serve(write_fd)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        self.workers[pid] = Worker(read_fd)
+        print(f"supervisor: started worker {pid}")
+        return pid
+
+    def _poll(self, timeout: float) -> None:
+        fds = {worker.fd: worker for worker in self.workers.values() if not worker.gone}
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except InterruptedError:
+            return
+        for fd in readable:
+            data = os.read(fd, 1024)
+            if not data:
+                fds[fd].gone = True
+                continue
+            fds[fd].beat = time.monotonic()
+            fds[fd].ready = fds[fd].ready or READY in data
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.fd)
+            print(f"supervisor: worker {pid} exited with status {status}")
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif not self.stopping:
+                self.spawn()
+
+    def _check_health(self) -> None:
+        now = time.monotonic()
+        for pid, worker in list(self.workers.items()):
+            if pid in self.retiring or worker.gone:
+                continue
+            if worker.ready and now - worker.beat > self.heartbeat_timeout:
+                print(f"supervisor: worker {pid} stopped beating, killing it")
+                self._kill(pid, signal.SIGKILL)
+            elif not worker.ready and now - worker.started > self.startup_timeout:
+                print(f"supervisor: worker {pid} did not start in time, killing it")
+                self._kill(pid, signal.SIGKILL)
+
+    def _kill(self, pid: int, sig: int) -> None:
+        if sig == signal.SIGKILL and pid in self.workers:
+            self.workers[pid].gone = True
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _wait_ready(self, pid: int) -> bool:
+        while pid in self.workers and not self.stopping:
+            self._poll(0.5)
+            self._reap()
+            worker = self.workers.get(pid)
+            if worker is not None and worker.ready:
+                return True
+            if (
+                worker is not None
+                and time.monotonic() - worker.started > self.startup_timeout
+            ):
+                return False
+        return False
+
+    def _rolling_restart(self) -> None:
+        self.restarting = False
+        for old in [pid for pid in self.workers if pid not in self.retiring]:
+            new = self.spawn()
+            if not self._wait_ready(new):
+                print("supervisor: new worker failed to start, restart aborted")
+                self.retiring.add(new)
+                self._kill(new, signal.SIGKILL)
+                return
+            # The old worker stops accepting and finishes its requests
+            self.retiring.add(old)
+            self._kill(old, signal.SIGTERM)
+
+    def _request_stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def _request_restart(self, signum, frame) -> None:
+        self.restarting = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_restart)
+        for _ in range(self.size):
+            self.spawn()
+        while not self.stopping:
+            self._poll(1)
+            self._reap()
+            self._check_health()
+            if self.restarting:
+                self._rolling_restart()
+
+        for pid in self.workers:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.workers and time.monotonic() < deadline:
+            self._poll(0.5)
+            self._reap()
+        for pid in self.workers:
+            self._kill(pid, signal.SIGKILL)
+
+
+async def heartbeat(fd: int, interval: float) -> None:
+    """Tell the supervisor the event loop of this worker is still responsive."""
+    os.set_blocking(fd, False)
+    message = READY
+    while True:
+        try:
+            os.write(fd, message)
+        except BlockingIOError:
+            pass
+        message = BEAT
+        await asyncio.sleep(interval)
@@ -0,0 +1,74 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Tuple
+from langchain.schema import AgentAction
+import tiktoken
+
+
+class TokenBudget:
+    """Token limits applied to tool observations and to the agent prompt."""
+
+    def __init__(
+        self,
+        model_name: str = "gpt-4",
+        max_prompt_tokens: int = 7000,
+        observation_tokens: int = 1500,
+        tool_observation_tokens: Dict[str, int] = None,
+    ) -> None:
+        self.encoding = tiktoken.encoding_for_model(model_name)
+        self.max_prompt_tokens = max_prompt_tokens
+        self.observation_tokens = observation_tokens
+        self.tool_observation_tokens = tool_observation_tokens or {}
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> "TokenBudget":
+        budget = config.get("budget", {})
+        return cls(
+            max_prompt_tokens=budget.get("max_prompt_tokens", 7000),
+            observation_tokens=budget.get("observation_tokens", 1500),
+            tool_observation_tokens=budget.get("tools", {}),
+        )
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Keep the head and the tail of a text so it fits in max_tokens."""
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        head = max_tokens * 2 // 3
+        tail = max_tokens - head
+        return (
+            self.encoding.decode(tokens[:head])
+            + f"\n[... {len(tokens) - max_tokens} tokens truncated ...]\n"
+            + (self.encoding.decode(tokens[-tail:]) if tail else "")
+        )
+
+    def limit_tool(self, name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Wrap a tool function or coroutine so its observations fit the tool budget."""
+        max_tokens = self.tool_observation_tokens.get(name, self.observation_tokens)
+
+        if asyncio.iscoroutinefunction(func):
+
+            async def limited_coroutine(*args: Any, **kwargs: Any) -> str:
+                return self.truncate(str(await func(*args, **kwargs)), max_tokens)
+
+            return limited_coroutine
+
+        def limited(*args: Any, **kwargs: Any) -> str:
+            return self.truncate(str(func(*args, **kwargs)), max_tokens)
+
+        return limited
+
+    def describe_steps(
+        self, intermediate_steps: List[Tuple[AgentAction, str]]
+    ) -> List[Dict[str, Any]]:
+        """Token counts of every step the agent took, for the response metadata."""
+        return [
+            {
+                "tool": action.tool,
+                "action_tokens": self.count(action.log),
+                "observation_tokens": self.count(str(observation)),
+            }
+            for action, observation in intermediate_steps
+        ]
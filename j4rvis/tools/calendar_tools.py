@@ -1,37 +1,204 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import caldav
+from caldav.elements import dav
+from caldav.lib.error import AuthorizationError, NotFoundError
 from datetime import datetime, timedelta
-from icalendar import Event
+from icalendar import Calendar, Event
 import pytz
 from .parsers import parse_input
 
+# Searches across calendars run on their own pool, the tool itself already holds
+# a thread of the shared tool executor
+search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="j4rvis-caldav")
 
-def calendar_tool(config, txt: str) -> str:
-    data = parse_input(txt)
-    action = data.get("action")
 
-    # Connect to the CalDAV server
-    client = caldav.DAVClient(
-        config["calendar"]["server_url"],
-        username=config["calendar"]["username"],
-        password=config["calendar"]["password"],
-    )
-    principal = client.principal()
-    calendars = principal.calendars()
+class CalendarConnection:
+    """A long-lived CalDAV client with its calendars discovered once and cached.
 
-    if not calendars:
-        return "No calendars found."
+    The client keeps its HTTP session alive between tool calls, and the
+    name -> calendar map is refreshed every refresh_interval seconds or when
+    the server rejects a request.
+    """
 
-    if action == "create_event":
-        event_data = data["data"]
+    def __init__(self, server_url, username, password, refresh_interval=900):
+        self.server_url = server_url
+        self.username = username
+        self.password = password
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.client = None
+        self.calendars = {}
+        self.discovered_at = 0.0
 
-        # Find the "Jarvis" calendar
-        jarvis_calendar = None
-        for calendar in calendars:
-            calendar_name = calendar.name  # Assuming the name property is available
-            if calendar_name == "Jarvis":
-                jarvis_calendar = calendar
-                break
+    def get_calendars(self, force=False):
+        with self.lock:
+            if self.client is None or force:
+                self.client = caldav.DAVClient(
+                    self.server_url, username=self.username, password=self.password
+                )
+            if (
+                force
+                or not self.calendars
+                or time.monotonic() - self.discovered_at > self.refresh_interval
+            ):
+                principal = self.client.principal()
+                self.calendars = {
+                    calendar.name: calendar for calendar in principal.calendars()
+                }
+                self.discovered_at = time.monotonic()
+            return self.calendars
+
+    def run(self, func):
+        """Call func with the calendars, discovering them again once if they went stale."""
+        try:
+            return func(self.get_calendars())
+        except (AuthorizationError, NotFoundError):
+            return func(self.get_calendars(force=True))
+
+
+def parse_events(calendar_name, ical_data):
+    """Compact records of the events of an iCal blob."""
+    records = []
+    for component in Calendar.from_ical(ical_data).walk("VEVENT"):
+        dtstart = component.get("dtstart")
+        dtend = component.get("dtend")
+        records.append(
+            {
+                "calendar": calendar_name,
+                "summary": str(component.get("summary", "")),
+                "start": dtstart.dt.isoformat() if dtstart else None,
+                "end": dtend.dt.isoformat() if dtend else None,
+                "location": str(component.get("location", "")) or None,
+            }
+        )
+    return records
+
+
+def _as_datetime(value):
+    """Naive local datetime of an event boundary, dates start at midnight."""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+def _overlaps(record, from_dt, to_dt):
+    if record["start"] is None:
+        return False
+    start = _as_datetime(record["start"])
+    end = _as_datetime(record["end"]) if record["end"] else start
+    return start < to_dt and end >= from_dt
+
+
+def _sync_token(calendar):
+    try:
+        return calendar.get_property(dav.SyncToken())
+    except Exception:
+        # The server does not support WebDAV sync
+        return None
+
+
+class EventCache:
+    """Parsed events of date range searches, kept while the calendar is unchanged.
 
+    A cached range is trusted for ttl seconds, then checked against the
+    calendar's sync token, which only costs a PROPFIND. When the token changed,
+    only the events changed since the cached one are fetched with a
+    sync-collection REPORT. Servers without sync tokens, and changes to
+    recurring events, get a new search of the range instead.
+    """
+
+    def __init__(self, ttl=30, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # (calendar url, from, to) -> (sync token, checked at, {href: records})
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def _fetch(name, calendar, from_dt, to_dt):
+        return {
+            str(event.url): parse_events(name, event.data)
+            for event in calendar.date_search(from_dt, to_dt)
+        }
+
+    @staticmethod
+    def _apply_changes(name, calendar, token, events, from_dt, to_dt):
+        """Sync token and events of a range after the changes since token, None to search again."""
+        try:
+            changes = calendar.objects_by_sync_token(
+                sync_token=token, load_objects=True
+            )
+        except Exception:
+            # The token expired or the server does not support sync-collection
+            return None
+        events = dict(events)
+        for event in changes:
+            events.pop(str(event.url), None)
+            # Deleted events have no data left
+            if not event.data:
+                continue
+            # The occurrences of recurring events are only expanded by the server
+            if "RRULE" in event.data:
+                return None
+            records = [
+                record
+                for record in parse_events(name, event.data)
+                if _overlaps(record, from_dt, to_dt)
+            ]
+            if records:
+                events[str(event.url)] = records
+        return changes.sync_token, events
+
+    def search(self, name, calendar, from_dt, to_dt):
+        key = (str(calendar.url), from_dt, to_dt)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            return [record for records in entry[2].values() for record in records]
+
+        token = _sync_token(calendar)
+        updated = None
+        if entry and token is not None and entry[0] is not None:
+            if token == entry[0]:
+                updated = token, entry[2]
+            else:
+                updated = self._apply_changes(
+                    name, calendar, entry[0], entry[2], from_dt, to_dt
+                )
+        if updated is None:
+            updated = token, self._fetch(name, calendar, from_dt, to_dt)
+        token, events = updated
+        with self.lock:
+            self.entries[key] = (token, time.monotonic(), events)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return [record for records in events.values() for record in records]
+
+    def invalidate(self, calendar):
+        # Checked against the calendar on the next search, instead of trusted for ttl
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == str(calendar.url)]:
+                token, _, events = self.entries[key]
+                self.entries[key] = (token, float("-inf"), events)
+
+
+def calendar_tool_builder(config):
+    connection = CalendarConnection(
+        config["calendar"]["server_url"],
+        config["calendar"]["username"],
+        config["calendar"]["password"],
+        config["calendar"].get("refresh_interval", 900),
+    )
+    event_cache = EventCache(config["calendar"].get("events_ttl", 30))
+
+    def create_event(calendars, event_data):
+        # Find the "Jarvis" calendar
+        jarvis_calendar = calendars.get("Jarvis")
         if not jarvis_calendar:
             return "Jarvis calendar not found."
 
@@ -45,28 +212,54 @@ def calendar_tool(config, txt: str) -> str:
 
         # Add the event to the "Jarvis" calendar
         jarvis_calendar.add_event(event.to_ical())
+        event_cache.invalidate(jarvis_calendar)
         return "Event created successfully."
 
-    elif action == "get_events":
-        from_dt_str = data["data"]["from_dt"]
-        to_dt_str = data["data"]["to_dt"]
+    def get_events(calendars, from_dt, to_dt):
+        # Search all calendars at the same time
+        results = search_pool.map(
+            lambda item: event_cache.search(item[0], item[1], from_dt, to_dt),
+            calendars.items(),
+        )
+        event_list = [event for events in results for event in events]
+        # Calendars mix dates, naive and zoned times, they are compared in local time
+        return sorted(
+            event_list,
+            key=lambda event: (
+                _as_datetime(event["start"]) if event["start"] else datetime.min
+            ),
+        )
+
+    def calendar_tool(txt: str) -> str:
+        data = parse_input(txt)
+        action = data.get("action")
 
-        # Convert the date strings to datetime objects
-        from_dt = datetime.strptime(from_dt_str, "%Y-%m-%d")
-        to_dt = datetime.strptime(to_dt_str, "%Y-%m-%d") + timedelta(days=1)
+        if action == "create_event":
+            return connection.run(
+                lambda calendars: (
+                    create_event(calendars, data["data"])
+                    if calendars
+                    else "No calendars found."
+                )
+            )
 
-        event_list = []
+        elif action == "get_events":
+            from_dt_str = data["data"]["from_dt"]
+            to_dt_str = data["data"]["to_dt"]
 
-        # Iterate through all calendars
-        for calendar in calendars:
-            events = calendar.date_search(from_dt, to_dt)
+            # Convert the date strings to datetime objects
+            from_dt = datetime.strptime(from_dt_str, "%Y-%m-%d")
+            to_dt = datetime.strptime(to_dt_str, "%Y-%m-%d") + timedelta(days=1)
 
-            for event in events:
-                print(event)
-                event_data = event.data
-                event_list.append(event_data)
+            return connection.run(
+                lambda calendars: (
+                    get_events(calendars, from_dt, to_dt)
+                    if calendars
+                    else "No calendars found."
+                )
+            )
 
-        return event_list
+        else:
+            return "Invalid action for the Calendar Tool."
 
-    else:
-        return "Invalid action for the Calendar Tool."
+    return calendar_tool
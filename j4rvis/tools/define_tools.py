@@ -1,53 +1,94 @@
 import getpass
+import asyncio
 from typing import Any
 from langchain.agents import Tool
-from langchain.utilities import (
-    WikipediaAPIWrapper,
-    GoogleSearchAPIWrapper,
-    PythonREPL,
+from .email_tools import (
+    email_deliverer_builder,
+    email_status_builder,
+    send_email_builder,
 )
-from .parsers import remove_code_block
-from .email_tools import send_email_builder
-from .calendar_tools import calendar_tool
-from .misc_tools import shell_tool_runner, _get_platform
+from .email_queue import configure_email_queue
+from .calendar_tools import calendar_tool_builder
+from .misc_tools import shell_tool_runner_builder, _get_platform
 from .unsplash_tools import search_images_runner_builder
-from .pdf_tools import html_to_pdf_runner
+from .search_tools import google_search_runner_builder, wikipedia_runner_builder
+from .cache import TTLCache
+from .python_tools import python_repl_runner_builder
+from .workspace import configure_artifacts
+from .pdf_tools import html_to_pdf_runner_builder
 from .document_tools import document_tool_builder
-from langchain.chat_models import ChatOpenAI
+from .templates import configure_templates
+from .executor import configure_executor, to_async
+from .budget import TokenBudget
+from .llm_cache import CachedChatOpenAI, configure_cache
 
 
-def define_tools(config: dict[str, Any]):
-    return [
+def define_tools(config: dict[str, Any], budget: TokenBudget):
+    configure_executor(config["server"].get("tool_workers", 8))
+    configure_cache(config)
+    artifacts = configure_artifacts(config)
+    email_queue = configure_email_queue(
+        config,
+        email_deliverer_builder(
+            config["email"]["username"],
+            config["email"]["password"],
+            config["email"]["server_url"],
+            config["email"]["port"],
+            config["email"].get("pool_size", 2),
+        ),
+    )
+    search = config.get("search", {})
+    # Google and Wikipedia results share one cache
+    search_cache = TTLCache(
+        search.get("cache_size", 512), search.get("cache_ttl", 3600)
+    )
+    shell_tool_runner = shell_tool_runner_builder(config)
+    tools = [
         Tool(
             name="Email Sender",
-            func=send_email_builder(
-                config["email"]["username"],
-                config["email"]["password"],
-                config["email"]["server_url"],
-                config["email"]["port"],
-            ),
+            func=send_email_builder(email_queue, artifacts),
             description=(
                 "A way to send emails from your own account, j4rvis.assistant@gmail.com."
                 "Input should be a json object with string fields 'to_email', 'subject', 'body' and an array of strings field 'files'."
+                "To send several emails at once, input can also be a json array of such objects."
                 "The body contains your message in HTML format. It must be well-formulated and classy."
-                "The files is a list of paths of files from your computer you want to send at attachments."
+                "The files is a list of paths of files from your computer, or ids of generated "
+                "PDFs, you want to send at attachments. "
+                "Generated documents must be converted with HTML to PDF before being attached."
                 "You must specify in it that you are Mr. Thomas Marchand's assistant. "
-                "The output will be a confirmation the email was sent or an error."
+                "Emails are queued and delivered in the background, "
+                "the output is the id of each queued email."
+            ),
+        ),
+        Tool(
+            name="Email Status",
+            func=email_status_builder(email_queue),
+            description=(
+                "Check the delivery of an email queued by the Email Sender. "
+                "Input should be the id of the email. The output tells if the email is "
+                "queued, sent or failed, with the number of attempts and the last error."
             ),
         ),
         Tool(
             name="Calendar",
-            func=lambda txt: calendar_tool(config, txt),
+            func=calendar_tool_builder(config),
             description=(
                 "A Calendar Tool to create events and retrieve events within a specific date range on your employer calendar. "
                 "The input should be a JSON object with 'action' key and optional 'data' key. "
                 'To create an event: \'{"action": "create_event", "data": {"summary": "My Event", "dtstart": "2023-06-01T12:00:00", "dtend": "2023-06-01T13:00:00"}}\'. '
-                'To get events: \'{"action": "get_events", "data": {"from_dt": "2023-06-01", "to_dt": "2023-06-30"}}\''
+                'To get events: \'{"action": "get_events", '
+                '"data": {"from_dt": "2023-06-01", "to_dt": "2023-06-30"}}\'. '
+                "Events are returned as a list of objects with calendar, summary, start, end "
+                "and location keys."
             ),
         ),
         Tool(
             name="Wikipedia",
-            func=WikipediaAPIWrapper().run,
+            func=wikipedia_runner_builder(
+                search_cache,
+                search.get("wikipedia_results", 2),
+                search.get("wikipedia_chars", 3000),
+            ),
             description=(
                 "A wrapper around Wikipedia. "
                 "Useful for when you need to answer general questions about "
@@ -57,7 +98,7 @@ def define_tools(config: dict[str, Any]):
         ),
         Tool(
             name="Google Search",
-            func=lambda txt: str(GoogleSearchAPIWrapper().results(txt, 10)),
+            func=google_search_runner_builder(search_cache),
             description=(
                 "A wrapper around the Google search engine. Useful for when "
                 "you need to answer questions about current events. "
@@ -75,36 +116,49 @@ def define_tools(config: dict[str, Any]):
             description=(
                 "A wrapper around an images search engine. Useful for when "
                 "you need to find beautiful illustrations for a simple input. "
+                "Input is a search query, or a json object with 'query' and optional "
+                "'per_page' (default 5) and 'page' (default 1) keys to get more results. "
                 "Output is an array of json objects with description, full_image and small_image urls. "
                 "Use the small image url when answering in markdown."
             ),
         ),
         Tool(
             name="Python REPL",
-            func=lambda txt: PythonREPL().run(remove_code_block(txt)),
+            func=python_repl_runner_builder(config),
             description=(
                 "A Python shell. Use this to execute python commands. "
                 "Input should be a valid python command. "
                 "If you want to see the output of a value, you should print it out "
-                "with `print(...)`."
+                "with `print(...)`. "
+                "Variables you define are kept for the next Python REPL calls of this "
+                "conversation, but they can be lost when the session is reset, redefine them "
+                "if you are told so."
             ),
         ),
         Tool(
             name="Terminal",
-            func=shell_tool_runner,
+            func=lambda txt: asyncio.run(shell_tool_runner(txt)),
+            coroutine=shell_tool_runner,
             description=(
                 f"Run shell commands on this {_get_platform()} machine and returns the output."
                 f"Use this as your own machine, you are connected as '{getpass.getuser()}'."
                 "Useful when you need to manage and write files or when you need to query the internet."
                 "Input must be a json object with a list of commands, for example:"
                 '{"commands": ["echo \'Hello World!'
-                '", "time"]}'
+                '", "time"]}. '
+                'Commands run one after the other in the same shell. Add "parallel": true '
+                "to run independent commands at the same time, each in its own shell. "
+                f"Commands are killed after {config.get('terminal', {}).get('timeout', 30)} "
+                "seconds "
+                "and long outputs are cut in the middle."
             ),
         ),
         Tool(
             name="Document Generator",
             func=document_tool_builder(
-                ChatOpenAI(model_name="gpt-4", temperature=0.15)
+                CachedChatOpenAI(model_name="gpt-4", temperature=0.15, streaming=True),
+                artifacts,
+                configure_templates(config),
             ),
             description=(
                 "An AI document generator that generates an HTML and CSS document "
@@ -115,18 +169,36 @@ def define_tools(config: dict[str, Any]):
                 "necessary information, as this tool does not have access to any user data "
                 "not provided in the input. This means any personal or banking information "
                 "needed in the document must be specified in the input description. "
-                "The output will be a string message indicating the success of the operation "
-                "and paths to the generated HTML and CSS files."
+                "The output will be a string message indicating the success of the operation, "
+                "the id of the document and paths to the generated HTML and CSS files."
             ),
         ),
         Tool(
             name="HTML to PDF",
-            func=html_to_pdf_runner,
+            func=html_to_pdf_runner_builder(config, artifacts),
             description=(
                 "A tool to convert HTML and CSS files to a PDF file. "
-                "Input is a JSON object with two keys 'html' and 'css', both strings indicating the paths to the files. "
-                "'output' key is optional and specifies the output PDF file path. If not provided, output.pdf will be used. "
-                "Output will be a string message indicating the success or failure of the operation."
+                "Input is a JSON object with a 'document' key holding the id of a generated "
+                "document, or two keys 'html' and 'css', both strings indicating the paths to "
+                "the files. 'output' key is optional and specifies the PDF file name. "
+                "If not provided, output.pdf will be used. "
+                "Output will be a string message indicating the success or failure of the "
+                "operation, "
+                "with the id and path of the PDF. "
+                "To create several PDFs at once, input can also be a JSON array of such objects."
             ),
         ),
     ]
+    agent = config.get("agent", {})
+    for tool in tools:
+        # Observations are truncated before they reach the scratchpad
+        tool.func = budget.limit_tool(tool.name, tool.func)
+        if tool.coroutine is not None:
+            tool.coroutine = budget.limit_tool(tool.name, tool.coroutine)
+            continue
+        # Tools are blocking, run them on the bounded executor when the agent is async
+        timeout = agent.get("tool_timeouts", {}).get(
+            tool.name, agent.get("tool_timeout", 60)
+        )
+        tool.coroutine = to_async(tool.func, timeout)
+    return tools
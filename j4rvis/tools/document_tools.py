@@ -6,7 +6,23 @@ from langchain.prompts.chat import (
     ChatPromptTemplate,
     HumanMessagePromptTemplate,
 )
+from .templates import CONTENT, SUBTITLE, TITLE
 
+# Shared by the prompts generating whole documents and document templates
+STYLE_GUIDELINES = (
+    "- The document should be designed for an A4 format, with an aspect ratio corresponding "
+    "to the square root of 2 (1:1.4142). "
+    "This should be reflected in the layout of the HTML elements and the CSS styles.\n"
+    "- The primary font should be Verdana, with 'Times New Roman' used for title elements.\n"
+    "- The primary font size should be 16px, with title elements at 70px and subtitles at 32px.\n"
+    "- The primary color for text should be black (#000000), with lighter shades used for "
+    "non-primary text.\n"
+    "- The background color should be #f5f5ef.\n"
+    "- The document should have a margin to ensure content doesn't touch the edges of the A4 "
+    "page.\n"
+    "- Tables should have their rows evenly spaced, with borders between rows, and headers "
+    "should be bold.\n\n"
+)
 
 human_message_prompt = HumanMessagePromptTemplate(
     prompt=PromptTemplate(
@@ -16,16 +32,9 @@ human_message_prompt = HumanMessagePromptTemplate(
             "and professional design aesthetic. Use vertical space effectively "
             "and evenly distribute content over the entire height of the document."
             "Here are the specific style guidelines to follow:\n\n"
-            "- The document should be designed for an A4 format, with an aspect ratio corresponding to the square root of 2 (1:1.4142). "
-            "This should be reflected in the layout of the HTML elements and the CSS styles.\n"
-            "- The primary font should be Verdana, with 'Times New Roman' used for title elements.\n"
-            "- The primary font size should be 16px, with title elements at 70px and subtitles at 32px.\n"
-            "- The primary color for text should be black (#000000), with lighter shades used for non-primary text.\n"
-            "- The background color should be #f5f5ef.\n"
-            "- The document should have a margin to ensure content doesn't touch the edges of the A4 page.\n"
-            "- Tables should have their rows evenly spaced, with borders between rows, and headers should be bold.\n\n"
-            "Now, based on these style guidelines and the document description provided, generate "
-            "the HTML and CSS documents.\n\n"
+            + STYLE_GUIDELINES
+            + "Now, based on these style guidelines and the document description provided, "
+            "generate the HTML and CSS documents.\n\n"
             "Document Description:\n\n"
             "{description}\n"
             "Please provide the HTML and CSS in a clean and easily readable format. "
@@ -43,41 +52,272 @@ human_message_prompt = HumanMessagePromptTemplate(
     )
 )
 
+template_message_prompt = HumanMessagePromptTemplate(
+    prompt=PromptTemplate(
+        template=(
+            "As an AI document designer, your task is to generate a reusable HTML and CSS "
+            "template for documents of type '{kind}'. The template should adhere to a clean and "
+            "professional design aesthetic. Use vertical space effectively and evenly distribute "
+            "content over the entire height of the document. "
+            "Here are the specific style guidelines to follow:\n\n"
+            + STYLE_GUIDELINES
+            + "The HTML must not contain any actual content. Instead it must contain the "
+            f"placeholders {TITLE}, {SUBTITLE} and {CONTENT}, each exactly once, where the title, "
+            f"the subtitle and the body of the document go. {CONTENT} is replaced by a sequence "
+            "of h2, p, ul and table elements, so the CSS must style these elements.\n\n"
+            "Output Format: The output should contain two parts: 'HTML' and 'CSS'. "
+            "The HTML must refer to the CSS as a second file called styles.css. "
+            "Each part should start with a title line: 'HTML:' or 'CSS:', followed by the respective code. "
+            "Example: \n\nHTML:\n<html>...</html>\n\nCSS:\nbody ... \n\n"
+            "Begin!"
+        ),
+        input_variables=["kind"],
+    )
+)
+
+content_message_prompt = HumanMessagePromptTemplate(
+    prompt=PromptTemplate(
+        template=(
+            "Write the content of the document described below as a JSON object, without any "
+            "markup or styling. The content should precisely match the document description, "
+            "and not contain placeholders or template items.\n\n"
+            "Document Description:\n\n"
+            "{description}\n\n"
+            "Output Format: answer only with a JSON object of this form:\n"
+            '{{"kind": "type of document in one or two words, like invoice or cover letter", '
+            '"title": "...", "subtitle": "...", "blocks": [...]}}\n'
+            "where each block is one of:\n"
+            '{{"type": "heading", "text": "..."}}\n'
+            '{{"type": "paragraph", "text": "..."}}\n'
+            '{{"type": "list", "items": ["...", "..."]}}\n'
+            '{{"type": "table", "headers": ["...", "..."], "rows": [["...", "..."]]}}\n\n'
+            "Begin!"
+        ),
+        input_variables=["description"],
+    )
+)
+
 
 import os
+import json
+import shutil
+from html import escape
+from typing import Any, Dict, List, Optional
+from langchain.callbacks.base import BaseCallbackHandler
+from .templates import TemplateStore
+from .workspace import ArtifactStore
+
+# Added to the description when the first completion did not follow the output format
+FORMAT_REMINDER = (
+    "\n\nYour previous answer did not follow the output format. Start directly with "
+    "the line 'HTML:' followed by the HTML code, then the line 'CSS:' followed by the "
+    "CSS code, and nothing else."
+)
 
 
-def document_tool_builder(chat: BaseLanguageModel):
+class MalformedDocument(ValueError):
+    pass
+
+
+class DocumentStreamParser(BaseCallbackHandler):
+    """Writes the HTML and CSS sections of a streamed completion while it arrives.
+
+    It raises as soon as the output stops following the 'HTML:'/'CSS:'
+    structure, which aborts the completion instead of paying for all of it.
+    """
+
+    raise_error = True
+    # A marker can be split across tokens, keep enough characters to see it whole
+    HOLDBACK = len("HTML:") - 1
+
+    def __init__(
+        self, html_path: str, css_path: str, preamble_limit: int = 200
+    ) -> None:
+        self.paths = {"html": html_path, "css": css_path}
+        self.preamble_limit = preamble_limit
+        self.section = None
+        self.pending = ""
+        self.received = 0
+        self.sizes = {"html": 0, "css": 0}
+        self.files = {}
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.feed(token)
+
+    def _write(self, section: str, text: str) -> None:
+        if not self.sizes[section]:
+            text = text.lstrip()
+        if not text:
+            return
+        if section not in self.files:
+            self.files[section] = open(self.paths[section], "w", encoding="utf-8")
+        self.files[section].write(text)
+        self.sizes[section] += len(text)
+
+    def feed(self, text: str) -> None:
+        self.received += len(text)
+        self.pending += text
+        while True:
+            if self.section is None:
+                index = self.pending.find("HTML:")
+                if index == -1:
+                    if len(self.pending) > self.preamble_limit:
+                        raise MalformedDocument(
+                            "the output does not start with 'HTML:'"
+                        )
+                    return
+                self.pending = self.pending[index + len("HTML:") :]
+                self.section = "html"
+            elif self.section == "html":
+                if "HTML:" in self.pending:
+                    raise MalformedDocument(
+                        "the output has more than one 'HTML:' section"
+                    )
+                index = self.pending.find("CSS:")
+                if index == -1:
+                    cut = max(0, len(self.pending) - self.HOLDBACK)
+                    self._write("html", self.pending[:cut])
+                    self.pending = self.pending[cut:]
+                    return
+                self._write("html", self.pending[:index])
+                self.pending = self.pending[index + len("CSS:") :]
+                self.section = "css"
+            else:
+                if "HTML:" in self.pending or "CSS:" in self.pending:
+                    raise MalformedDocument(
+                        "the output has more than one 'CSS:' section"
+                    )
+                cut = max(0, len(self.pending) - self.HOLDBACK)
+                self._write("css", self.pending[:cut])
+                self.pending = self.pending[cut:]
+                return
+
+    def finish(self) -> None:
+        if self.section is not None:
+            self._write(self.section, self.pending.rstrip())
+        self.pending = ""
+        if self.section != "css" or not self.sizes["html"] or not self.sizes["css"]:
+            raise MalformedDocument("the output is missing its HTML or CSS part")
+
+    def close(self) -> None:
+        for file in self.files.values():
+            file.close()
+
+
+def parse_content(llm_output: str) -> Dict[str, Any]:
+    """The JSON content of a document, ignoring any text or code fence around it."""
+    start, end = llm_output.find("{"), llm_output.rfind("}")
+    content = json.loads(llm_output[start : end + 1]) if start != -1 else None
+    if not isinstance(content, dict) or not isinstance(content.get("blocks"), list):
+        raise MalformedDocument("the content is not a JSON object with a 'blocks' list")
+    return content
+
+
+def render_blocks(blocks: List[Dict[str, Any]]) -> str:
+    parts = []
+    for block in blocks:
+        kind = block.get("type")
+        if kind == "heading":
+            parts.append(f"<h2>{escape(str(block.get('text', '')))}</h2>")
+        elif kind == "list":
+            items = "".join(
+                f"<li>{escape(str(item))}</li>" for item in block.get("items", [])
+            )
+            parts.append(f"<ul>{items}</ul>")
+        elif kind == "table":
+            headers = "".join(
+                f"<th>{escape(str(cell))}</th>" for cell in block.get("headers", [])
+            )
+            rows = "".join(
+                "<tr>"
+                + "".join(f"<td>{escape(str(cell))}</td>" for cell in row)
+                + "</tr>"
+                for row in block.get("rows", [])
+            )
+            parts.append(
+                f"<table><thead><tr>{headers}</tr></thead><tbody>{rows}</tbody></table>"
+            )
+        else:
+            text = escape(str(block.get("text", ""))).replace("\n", "<br>")
+            parts.append(f"<p>{text}</p>")
+    return "\n".join(parts)
+
+
+def document_tool_builder(
+    chat: BaseLanguageModel,
+    artifacts: ArtifactStore,
+    templates: Optional[TemplateStore] = None,
+):
     chat_prompt_template = ChatPromptTemplate.from_messages([human_message_prompt])
     document_chain = LLMChain(llm=chat, prompt=chat_prompt_template)
+    template_chain = LLMChain(
+        llm=chat, prompt=ChatPromptTemplate.from_messages([template_message_prompt])
+    )
+    content_chain = LLMChain(
+        llm=chat, prompt=ChatPromptTemplate.from_messages([content_message_prompt])
+    )
+
+    def generate(chain, input, html_path, css_path):
+        parser = DocumentStreamParser(html_path, css_path)
+        try:
+            llm_output = chain.run(input, callbacks=[parser])
+            # Without streaming the whole completion is parsed at once
+            if not parser.received:
+                parser.feed(llm_output)
+            parser.finish()
+        finally:
+            parser.close()
+
+    def generate_with_retry(chain, input, html_path, css_path):
+        try:
+            generate(chain, input, html_path, css_path)
+        except MalformedDocument:
+            # Ask once more, reminding the expected structure
+            generate(chain, input + FORMAT_REMINDER, html_path, css_path)
+
+    def generate_template(kind, html_path, css_path):
+        generate_with_retry(template_chain, kind, html_path, css_path)
+
+    def render_from_template(description, html_path, css_path):
+        """Ask only for the content and render it in the cached template of its kind."""
+        content = parse_content(content_chain.run(description))
+        kind = str(content.get("kind") or "document")
+        skeleton_path, styles_path = templates.get_or_create(kind, generate_template)
+        with open(skeleton_path, encoding="utf-8") as file:
+            skeleton = file.read()
+        html = (
+            skeleton.replace(TITLE, escape(str(content.get("title", ""))))
+            .replace(SUBTITLE, escape(str(content.get("subtitle", ""))))
+            .replace(CONTENT, render_blocks(content["blocks"]))
+        )
+        with open(html_path, "w", encoding="utf-8") as file:
+            file.write(html)
+        shutil.copyfile(styles_path, css_path)
 
     def document_tool_runner(description):
-        llm_output = document_chain.run(description)
-
-        # Split the output by 'CSS:' to separate HTML and CSS parts
-        split_output = llm_output.split("CSS:")
-        if len(split_output) != 2:
-            raise ValueError(f"Could not parse LLM output: `{llm_output}`")
-
-        # Remove 'HTML:' from the first part and strip extra whitespace
-        html_output = split_output[0].replace("HTML:", "").strip()
-        css_output = split_output[1].strip()
-
-        # If both HTML and CSS are present, write them into respective files
-        if html_output and css_output:
-            # Create the 'generated' directory if it does not exist
-            os.makedirs("generated", exist_ok=True)
-
-            # Define the paths to store the files inside 'generated' folder
-            html_path = "generated/index.html"
-            css_path = "generated/styles.css"
-            with open(html_path, "w", encoding="utf-8") as html_file:
-                html_file.write(html_output)
-            with open(css_path, "w", encoding="utf-8") as css_file:
-                css_file.write(css_output)
-            return f"Document generated with success, html_path: '{html_path}', css_path: '{css_path}'"
-
-        # If output is not in the expected format, raise an error
-        raise ValueError(f"Could not parse LLM output: `{llm_output}`")
+        # Each document gets its own directory in the workspace of the request
+        document_id, html_path = artifacts.new_path("index.html")
+        css_path = os.path.join(os.path.dirname(html_path), "styles.css")
+
+        try:
+            try:
+                if templates is None:
+                    raise MalformedDocument("document templates are disabled")
+                render_from_template(description, html_path, css_path)
+            except (ValueError, OSError):
+                # Documents that do not fit a template are generated in full
+                generate_with_retry(document_chain, description, html_path, css_path)
+        except MalformedDocument as e:
+            artifacts.discard(document_id)
+            raise ValueError(f"Could not parse LLM output: {e}")
+        except BaseException:
+            artifacts.discard(document_id)
+            raise
+
+        artifacts.register(document_id, "document", os.path.dirname(html_path))
+        return (
+            f"Document generated with success, document id: '{document_id}', "
+            f"html_path: '{html_path}', css_path: '{css_path}'"
+        )
 
     return document_tool_runner
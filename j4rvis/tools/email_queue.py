@@ -0,0 +1,180 @@
+import os
+import json
+import smtplib
+import time
+import sqlite3
+import threading
+import traceback
+from uuid import uuid4
+from typing import Any, Callable, Dict, Optional
+
+# Errors retrying cannot fix
+PERMANENT_ERRORS = (
+    KeyError,
+    ValueError,
+    FileNotFoundError,
+    smtplib.SMTPRecipientsRefused,
+)
+
+
+class EmailQueue:
+    """Durable outbox of emails, delivered by a background thread.
+
+    Failed deliveries are retried with an exponential backoff until
+    max_attempts is reached. Several processes can share the outbox, each
+    email is claimed by one of them, and emails left 'sending' by a process
+    that died are queued again after stale_after seconds.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        deliver: Callable[[Dict[str, Any]], None],
+        max_attempts: int = 5,
+        retry_delay: float = 30,
+        stale_after: float = 600,
+    ) -> None:
+        self.deliver = deliver
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+        self.recovered_at = 0.0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Shared by the server processes, a busy database is waited for
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id TEXT PRIMARY KEY, payload TEXT, status TEXT, attempts INTEGER, "
+            "next_attempt REAL, error TEXT, created REAL, updated REAL)"
+        )
+        self.db.commit()
+        self.worker = None
+
+    def start(self) -> None:
+        if self.worker is None:
+            self.worker = threading.Thread(
+                target=self._work, name="j4rvis-email", daemon=True
+            )
+            self.worker.start()
+
+    def enqueue(self, message: Dict[str, Any]) -> str:
+        id = uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO outbox VALUES (?, ?, 'queued', 0, ?, NULL, ?, ?)",
+                (id, json.dumps(message), now, now, now),
+            )
+            self.db.commit()
+        self.wakeup.set()
+        return id
+
+    def status(self, id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT payload, status, attempts, error, created, updated "
+                "FROM outbox WHERE id = ?",
+                (id,),
+            ).fetchone()
+        if row is None:
+            return None
+        payload, status, attempts, error, created, updated = row
+        return {
+            "id": id,
+            "to_email": json.loads(payload).get("to_email"),
+            "status": status,
+            "attempts": attempts,
+            "error": error,
+            "created": created,
+            "updated": updated,
+        }
+
+    def _recover(self) -> None:
+        now = time.time()
+        if now - self.recovered_at < 60:
+            return
+        self.recovered_at = now
+        self.db.execute(
+            "UPDATE outbox SET status = 'queued' WHERE status = 'sending' AND updated < ?",
+            (now - self.stale_after,),
+        )
+        self.db.commit()
+
+    def _next(self) -> Optional[tuple]:
+        with self.lock:
+            self._recover()
+            row = self.db.execute(
+                "SELECT id, payload, attempts FROM outbox "
+                "WHERE status = 'queued' AND next_attempt <= ? "
+                "ORDER BY next_attempt LIMIT 1",
+                (time.time(),),
+            ).fetchone()
+            if row is not None:
+                # Another process may have claimed the same email in the meantime
+                claimed = self.db.execute(
+                    "UPDATE outbox SET status = 'sending', updated = ? "
+                    "WHERE id = ? AND status = 'queued'",
+                    (time.time(), row[0]),
+                ).rowcount
+                self.db.commit()
+                if not claimed:
+                    return None
+        return row
+
+    def _finish(self, id: str, status: str, attempts: int, error=None, delay=0.0):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, error = ?, "
+                "next_attempt = ?, updated = ? WHERE id = ?",
+                (status, attempts, error, now + delay, now, id),
+            )
+            self.db.commit()
+
+    def _work(self) -> None:
+        while True:
+            row = self._next()
+            if row is None:
+                # Claims lost to another process are retried after the wait
+                self.wakeup.wait(timeout=1)
+                self.wakeup.clear()
+                continue
+            id, payload, attempts = row
+            attempts += 1
+            try:
+                self.deliver(json.loads(payload))
+                self._finish(id, "sent", attempts)
+            except PERMANENT_ERRORS as e:
+                self._finish(id, "failed", attempts, str(e))
+            except Exception as e:
+                traceback.print_exc()
+                if attempts >= self.max_attempts:
+                    self._finish(id, "failed", attempts, str(e))
+                else:
+                    delay = self.retry_delay * 2 ** (attempts - 1)
+                    self._finish(id, "queued", attempts, str(e), delay)
+
+
+_queue: Optional[EmailQueue] = None
+
+
+def configure_email_queue(
+    config: dict[str, Any], deliver: Callable[[Dict[str, Any]], None]
+) -> EmailQueue:
+    global _queue
+    _queue = EmailQueue(
+        config["email"].get("queue_path", "data/email_queue.sqlite"),
+        deliver,
+        config["email"].get("max_attempts", 5),
+        config["email"].get("retry_delay", 30),
+    )
+    _queue.start()
+    return _queue
+
+
+def get_email_queue() -> Optional[EmailQueue]:
+    return _queue
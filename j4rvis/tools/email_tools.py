@@ -1,46 +1,297 @@
+import re
+import base64
 import smtplib
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from email import encoders
-from email.mime.base import MIMEBase
+from uuid import uuid4
+from email.message import EmailMessage
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.policy import SMTP
+from email.utils import formatdate, make_msgid, parseaddr
 from .parsers import parse_input
 
+# Multiple of 57 bytes so every chunk encodes to whole 76 characters base64 lines
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
 
-def send_email_builder(email, password, server_url, port):
-    def send_email(txt) -> str:
+
+class SMTPPool:
+    """Authenticated SMTP sessions reused across emails.
+
+    Idle sessions are checked with NOOP before being reused, broken ones are
+    closed and replaced by a fresh login.
+    """
+
+    def __init__(self, email, password, server_url, port, size=2):
+        self.email = email
+        self.password = password
+        self.server_url = server_url
+        self.port = port
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _connect(self):
+        server = smtplib.SMTP_SSL(self.server_url, self.port, timeout=30)
+        server.login(self.email, self.password)
+        return server
+
+    @staticmethod
+    def _healthy(server):
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    @staticmethod
+    def _reset(server):
+        try:
+            return server.rset()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _release(self, server):
+        with self.lock:
+            self.idle.append(server)
+
+    def _acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                server = self.idle.pop()
+            if self._healthy(server):
+                return server
+            self._close(server)
+        return self._connect()
+
+    @contextmanager
+    def session(self):
+        with self.slots:
+            server = self._acquire()
+            try:
+                yield server
+            except Exception:
+                # Abort the failed transaction so the session can be reused, or drop it
+                if self._reset(server):
+                    self._release(server)
+                else:
+                    self._close(server)
+                raise
+            self._release(server)
+
+
+def _quote_periods(data: bytes) -> bytes:
+    return re.sub(rb"(?m)^\.", b"..", data)
+
+
+def header_block(headers) -> bytes:
+    """Headers of a message or a part, encoded and folded by the email package.
+
+    Values with a line break are refused so they cannot add headers of their own.
+    """
+    message = EmailMessage(policy=SMTP)
+    for name, value, *params in headers:
+        if "\r" in value or "\n" in value:
+            raise ValueError(f"the {name} header cannot contain a line break")
+        # Parameters like filename are RFC 2231 encoded when they are not ASCII
+        message.add_header(name, value, **(params[0] if params else {}))
+    return (
+        b"".join(SMTP.fold_binary(name, value) for name, value in message.items())
+        + b"\r\n"
+    )
+
+
+def message_chunks(sender, to_email, subject, body, files):
+    """CRLF terminated chunks of a multipart email, attachments read piece by piece.
+
+    The headers are built right away, so invalid ones fail before anything is sent.
+    """
+    boundary = f"=={uuid4().hex}=="
+    headers = header_block(
+        [
+            ("From", sender),
+            ("To", to_email),
+            ("Subject", subject),
+            ("Date", formatdate(localtime=True)),
+            ("Message-ID", make_msgid()),
+            ("MIME-Version", "1.0"),
+            ("Content-Type", "multipart/mixed", {"boundary": boundary}),
+        ]
+    )
+    parts = [
+        header_block(
+            [
+                ("Content-Type", "application/octet-stream"),
+                ("Content-Transfer-Encoding", "base64"),
+                ("Content-Disposition", "attachment", {"filename": Path(path).name}),
+            ]
+        )
+        for path in files
+    ]
+
+    def chunks():
+        yield headers
+        yield f"--{boundary}\r\n".encode("utf-8")
+        yield _quote_periods(MIMEText(body, "html").as_bytes(policy=SMTP)) + b"\r\n"
+        for path, part in zip(files, parts):
+            yield f"--{boundary}\r\n".encode("utf-8") + part
+            with open(path, "rb") as file:
+                while chunk := file.read(ATTACHMENT_CHUNK_SIZE):
+                    yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+        yield f"--{boundary}--\r\n".encode("utf-8")
+
+    return chunks()
+
+
+def send_streaming(server, sender, to_email, chunks):
+    """Send a message with the DATA command, without building it in memory first."""
+    code, response = server.mail(sender)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    # The envelope only takes the address, without the display name
+    code, response = server.rcpt(parseaddr(to_email)[1])
+    if code not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({to_email: (code, response)})
+    code, response = server.docmd("data")
+    if code != 354:
+        raise smtplib.SMTPDataError(code, response)
+    try:
+        for chunk in chunks:
+            server.send(chunk)
+    except Exception:
+        # The server still waits for the end of the data, this session is unusable
+        server.close()
+        raise
+    server.send(b".\r\n")
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+
+
+def email_deliverer_builder(email, password, server_url, port, pool_size=2):
+    pool = SMTPPool(email, password, server_url, port, pool_size)
+
+    def send_one(server, data):
         # Email details
-        data = parse_input(txt)
         to_email = data["to_email"]
         subject = data["subject"]
         body = data["body"]
         files = data["files"] if "files" in data else []
+        for path in files:
+            if not Path(path).is_file():
+                raise FileNotFoundError(f"attachment not found: {path}")
+        send_streaming(
+            server,
+            email,
+            to_email,
+            message_chunks(email, to_email, subject, body, files),
+        )
 
-        # Create the MIME object
-        msg = MIMEMultipart()
-        msg["From"] = email
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, "html"))
+    def deliver(data) -> None:
+        try:
+            with pool.session() as server:
+                send_one(server, data)
+        except smtplib.SMTPServerDisconnected:
+            # The pooled session died during the send, retry on a new one
+            with pool.session() as server:
+                send_one(server, data)
 
-        for path in files:
-            part = MIMEBase("application", "octet-stream")
-            with open(path, "rb") as file:
-                part.set_payload(file.read())
-            encoders.encode_base64(part)
-            part.add_header(
-                "Content-Disposition", "attachment; filename={}".format(Path(path).name)
+    return deliver
+
+
+def send_email_builder(queue, artifacts):
+    def check(data):
+        """Resolved attachment paths of an email, or why it cannot be sent."""
+        if not isinstance(data, dict):
+            return None, "Email skipped: each email must be a JSON object."
+        if not all(
+            isinstance(data.get(key), str) for key in ("to_email", "subject", "body")
+        ):
+            return (
+                None,
+                "Email skipped: 'to_email', 'subject' and 'body' are required strings.",
+            )
+        if any(
+            "\r" in data[key] or "\n" in data[key] for key in ("to_email", "subject")
+        ):
+            return (
+                None,
+                "Email skipped: 'to_email' and 'subject' cannot contain line breaks.",
             )
-            msg.attach(part)
+        address = parseaddr(data["to_email"])[1]
+        if not re.fullmatch(r"[^@\s]+@[^@\s]+\.[^@\s]+", address):
+            return (
+                None,
+                f"Email skipped: '{data['to_email']}' is not a valid email address.",
+            )
+        files = data.get("files", [])
+        if isinstance(files, str):
+            files = [files]
+        if not isinstance(files, list) or not all(
+            isinstance(path, str) for path in files
+        ):
+            return None, (
+                f"Email to {data['to_email']} skipped: 'files' must be a list of paths or ids."
+            )
+        # Generated documents are directories, only their PDF can be attached
+        documents = [
+            path
+            for path in files
+            if (artifacts.get(path.strip()) or ("",))[0] == "document"
+        ]
+        if documents:
+            return None, (
+                f"Email to {data['to_email']} skipped: {', '.join(documents)} are document ids, "
+                "convert them with HTML to PDF and attach the PDF ids instead."
+            )
+        # Attachments can be given as artifact ids of the other tools
+        paths = [artifacts.resolve(path) for path in files]
+        missing = [path for path in paths if not Path(path).is_file()]
+        if missing:
+            return (
+                None,
+                f"Email to {data['to_email']} skipped: no file at {', '.join(missing)}.",
+            )
+        return paths, None
 
-        # Send the email
-        try:
-            with smtplib.SMTP_SSL(server_url, port) as server:
-                server.login(email, password)
-                text = msg.as_string()
-                server.sendmail(email, to_email, text)
-                return "Email sent successfully."
-        except Exception as e:
-            return f"Error occurred while sending the email: {e}"
+    def send_email(txt) -> str:
+        data = parse_input(txt)
+        # Several emails can be sent in one call with a list or a 'messages' key
+        if isinstance(data, list):
+            messages = data
+        else:
+            messages = data.get("messages", [data])
+
+        results = []
+        for data in messages:
+            # Checked before queueing so the agent learns about mistakes right away
+            files, error = check(data)
+            if error is not None:
+                results.append(error)
+                continue
+            data["files"] = files
+            id = queue.enqueue(data)
+            results.append(
+                f"Email to {data['to_email']} queued for delivery with id '{id}'."
+            )
+        return "\n".join(results)
 
     return send_email
+
+
+def email_status_builder(queue):
+    def email_status(txt) -> str:
+        status = queue.status(txt.strip().strip('"').strip("'"))
+        if status is None:
+            return "No email found with this id."
+        return str(status)
+
+    return email_status
@@ -0,0 +1,57 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def configure_executor(max_workers: int) -> None:
+    """Set the size of the thread pool used to run blocking tools."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="j4rvis-tool"
+    )
+
+
+def get_executor() -> ThreadPoolExecutor:
+    if _executor is None:
+        configure_executor(8)
+    return _executor
+
+
+async def run_in(
+    executor: ThreadPoolExecutor, func: Callable[..., Any], *args: Any, **kwargs: Any
+) -> Any:
+    """Run a blocking callable on the given executor without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context variables over to the worker thread
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    return await loop.run_in_executor(executor, call)
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking callable on the tool executor without blocking the event loop."""
+    return await run_in(get_executor(), func, *args, **kwargs)
+
+
+def to_async(
+    func: Callable[..., Any], timeout: Optional[float] = None
+) -> Callable[..., Awaitable[Any]]:
+    """Wrap a blocking tool function into a coroutine running on the executor.
+
+    Past the timeout the agent gets an error observation, the worker thread
+    cannot be interrupted and finishes in the background.
+    """
+
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        try:
+            return await asyncio.wait_for(run_blocking(func, *args, **kwargs), timeout)
+        except asyncio.TimeoutError:
+            return f"The tool did not answer within {timeout} seconds."
+
+    return wrapper
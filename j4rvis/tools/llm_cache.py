@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+from .executor import run_in
+
+# Set by the server when a request asks to skip cached completions
+cache_bypass: ContextVar[bool] = ContextVar("cache_bypass", default=False)
+
+# Only the date of the prompt's datetime line is kept in cache keys
+DATETIME_LINE = re.compile(r"(Current date and time: \d{4}-\d{2}-\d{2})[^\n]*")
+
+
+class CompletionCache:
+    """SQLite store of LLM completions with a TTL and least recently used eviction.
+
+    Hits only update the access times in memory, they are written in batches,
+    and the store is trimmed to max_entries every few insertions.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float,
+        max_entries: int,
+        flush_interval: float = 30,
+        trim_every: int = 64,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.trim_every = trim_every
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.accessed: Dict[str, float] = {}
+        self.flushed_at = time.time()
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+        )
+        self.db.commit()
+
+    def _flush(self) -> None:
+        self.flushed_at = time.time()
+        if self.accessed:
+            self.db.executemany(
+                "UPDATE completions SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self.accessed.items()],
+            )
+            self.accessed = {}
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] + self.ttl < now:
+                if row is not None:
+                    self.db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                    self.db.commit()
+                self.misses += 1
+                return None
+            self.accessed[key] = now
+            if now - self.flushed_at > self.flush_interval:
+                self._flush()
+                self.db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self.accessed.pop(key, None)
+            self.puts += 1
+            if self.puts % self.trim_every == 0:
+                # Evicted by their latest access, including the unwritten ones
+                self._flush()
+                (count,) = self.db.execute(
+                    "SELECT COUNT(*) FROM completions"
+                ).fetchone()
+                if count > self.max_entries:
+                    self.db.execute(
+                        "DELETE FROM completions WHERE key IN "
+                        "(SELECT key FROM completions ORDER BY accessed LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+            self.db.commit()
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            (count,) = self.db.execute("SELECT COUNT(*) FROM completions").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count}
+
+
+_cache: Optional[CompletionCache] = None
+# Cache reads and writes get their own threads, hung tools cannot hold them up
+_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="j4rvis-cache")
+
+
+def configure_cache(config: dict[str, Any]) -> None:
+    global _cache
+    cache = config.get("cache", {})
+    _cache = CompletionCache(
+        cache.get("path", "data/llm_cache.sqlite"),
+        cache.get("ttl", 3600),
+        cache.get("max_entries", 10000),
+    )
+
+
+def get_cache() -> Optional[CompletionCache]:
+    return _cache
+
+
+class CachedChatOpenAI(ChatOpenAI):
+    """ChatOpenAI answering identical prompts from the completion cache."""
+
+    def _cache_key(self, messages: List[BaseMessage], stop: Optional[List[str]]) -> str:
+        prompt = "\n".join(
+            [
+                message.type + ": " + DATETIME_LINE.sub(r"\1", message.content).strip()
+                for message in messages
+            ]
+        )
+        key = json.dumps([prompt, self.model_name, self.temperature, stop or []])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[ChatResult]:
+        if _cache is None or cache_bypass.get():
+            return None
+        content = _cache.get(key)
+        if content is None:
+            return None
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))]
+        )
+
+    def _store(self, key: str, result: ChatResult) -> None:
+        if _cache is not None:
+            _cache.put(key, result.generations[0].message.content)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._cache_key(messages, stop)
+        cached = self._lookup(key)
+        if cached is not None:
+            if self.streaming and run_manager:
+                run_manager.on_llm_new_token(cached.generations[0].message.content)
+            return cached
+        result = super()._generate(
+            messages, stop=stop, run_manager=run_manager, **kwargs
+        )
+        self._store(key, result)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._cache_key(messages, stop)
+        # The store is SQLite, it is read and written off the event loop
+        cached = await run_in(_pool, self._lookup, key)
+        if cached is not None:
+            if self.streaming and run_manager:
+                await run_manager.on_llm_new_token(
+                    cached.generations[0].message.content
+                )
+            return cached
+        result = await super()._agenerate(
+            messages, stop=stop, run_manager=run_manager, **kwargs
+        )
+        await run_in(_pool, self._store, key, result)
+        return result
@@ -1,8 +1,11 @@
-from langchain.tools import ShellTool
-from .parsers import parse_input
+import os
+import codecs
+import signal
+import asyncio
 import platform
+from .parsers import parse_input
+from .session import event_sink
 
-shell_tool = ShellTool()
 
 def _get_platform() -> str:
     """Get platform."""
@@ -11,6 +14,106 @@ def _get_platform() -> str:
         return "MacOS"
     return system
 
-def shell_tool_runner(txt) -> str:
-    data = parse_input(txt)
-    return shell_tool.run(data)
+
+class HeadTailBuffer:
+    """Keeps the beginning and the end of an output, drops the middle past the limit."""
+
+    def __init__(self, limit: int) -> None:
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = ""
+        self.tail = ""
+        self.dropped = 0
+
+    def write(self, text: str) -> None:
+        if len(self.head) < self.head_limit:
+            size = self.head_limit - len(self.head)
+            self.head += text[:size]
+            text = text[size:]
+        self.tail += text
+        if len(self.tail) > self.tail_limit:
+            self.dropped += len(self.tail) - self.tail_limit
+            self.tail = self.tail[-self.tail_limit :]
+
+    def getvalue(self) -> str:
+        if not self.dropped:
+            return self.head + self.tail
+        return f"{self.head}\n[... {self.dropped} characters dropped ...]\n{self.tail}"
+
+
+async def run_command(command: str, timeout: float, max_output: int) -> str:
+    """Run a shell command, streaming its output to the client if one listens."""
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        # Own process group so a timeout kills the command's children too
+        start_new_session=True,
+    )
+    buffer = HeadTailBuffer(max_output)
+    sink = event_sink.get()
+
+    async def pump() -> None:
+        # Characters split between two reads are decoded once complete
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            chunk = await process.stdout.read(4096)
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                buffer.write(text)
+                if sink is not None:
+                    await sink(
+                        {
+                            "type": "tool_output",
+                            "tool": "Terminal",
+                            "command": command,
+                            "content": text,
+                        }
+                    )
+            if not chunk:
+                break
+
+    running = asyncio.gather(pump(), process.wait())
+    finished = False
+    try:
+        await asyncio.wait_for(running, timeout)
+        finished = True
+    except asyncio.TimeoutError:
+        buffer.write(f"\n[command killed after {timeout} seconds]")
+    finally:
+        if not finished:
+            # Timed out, cancelled with the request or the client stopped listening
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            running.cancel()
+            await process.wait()
+        # Retrieved here so a failed output reader is never reported as unhandled
+        await asyncio.gather(running, return_exceptions=True)
+    return buffer.getvalue()
+
+
+def shell_tool_runner_builder(config):
+    terminal = config.get("terminal", {})
+    timeout = terminal.get("timeout", 30)
+    max_output = terminal.get("max_output", 8000)
+
+    async def shell_tool_runner(txt) -> str:
+        data = parse_input(txt)
+        commands = data["commands"]
+        if isinstance(commands, str):
+            commands = [commands]
+
+        if not data.get("parallel", False):
+            # Dependent commands share one shell, like `cd` followed by `ls`
+            return await run_command(";".join(commands), timeout, max_output)
+
+        outputs = await asyncio.gather(
+            *[run_command(command, timeout, max_output) for command in commands]
+        )
+        return "\n".join(
+            [f"$ {command}\n{output}" for command, output in zip(commands, outputs)]
+        )
+
+    return shell_tool_runner
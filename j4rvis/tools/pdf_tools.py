@@ -1,39 +1,216 @@
-import pdfkit
+import os
 import json
+import shutil
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+import pdfkit
+from .workspace import ArtifactStore
 
+# Options for pdfkit
+PDF_OPTIONS = {
+    "quiet": "",
+    "print-media-type": "",
+    "no-outline": None,
+    "encoding": "UTF-8",
+}
 
-def html_to_pdf_runner(input):
-    """
-    This function converts an HTML and CSS file to a PDF file.
-    Input is a JSON object with two keys 'html' and 'css', both strings indicating the paths to the files.
-    'output' key is optional and specifies the output PDF file path. If not provided, output.pdf will be used.
+
+class PDFRenderer:
+    """Renders HTML and CSS files to PDF on a bounded pool of wkhtmltopdf jobs.
+
+    Rendered PDFs are cached by the hash of their HTML and CSS, so an identical
+    document is copied from the cache instead of being rendered again, and
+    identical documents submitted at the same time share one job.
     """
 
-    # Extract data from input
-    try:
-        data = json.loads(input)
-        html_path = data.get("html")
-        css_path = data.get("css")
-        output_path = data.get("output", "output.pdf")
-    except (KeyError, json.JSONDecodeError):
-        raise ValueError(
-            "Invalid input. Please provide 'html' and 'css' paths in the input JSON."
+    def __init__(
+        self,
+        cache_dir: str,
+        workers: int = 2,
+        timeout: float = 60,
+        cache_size: int = 200,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.cache_size = cache_size
+        # Looked up on first use, so a missing wkhtmltopdf only fails conversions
+        self.configuration = None
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="j4rvis-pdf"
+        )
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, Future] = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def content_hash(html_path: str, css_path: Optional[str]) -> str:
+        digest = hashlib.sha256()
+        for path in (html_path, css_path):
+            if path:
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @staticmethod
+    def _complete(path: str) -> bool:
+        """Whether a file is a whole PDF, from its header and its trailer."""
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as file:
+            if file.read(5) != b"%PDF-":
+                return False
+            file.seek(max(0, os.path.getsize(path) - 1024))
+            return b"%%EOF" in file.read()
+
+    def _render(self, html_path: str, css_path: Optional[str], cached_path: str) -> str:
+        if self.configuration is None:
+            self.configuration = pdfkit.configuration()
+        options = dict(PDF_OPTIONS)
+        if css_path:
+            options["user-style-sheet"] = css_path
+        # Unique to this job, other processes may render the same document into the cache
+        temporary_path = f"{cached_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        # Run wkhtmltopdf ourselves so a stuck conversion can be killed
+        command = pdfkit.PDFKit(
+            html_path, "file", options=options, configuration=self.configuration
+        ).command(temporary_path)
+        try:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            try:
+                process = subprocess.run(
+                    command, capture_output=True, timeout=self.timeout
+                )
+            except subprocess.TimeoutExpired:
+                raise TimeoutError(f"rendering took more than {self.timeout} seconds")
+            # wkhtmltopdf fails on warnings even when the PDF is fine, so a failed
+            # run is only trusted when the file is a whole PDF
+            if not self._complete(temporary_path):
+                error = process.stderr.decode("utf-8", errors="replace").strip()[-500:]
+                raise RuntimeError(
+                    f"wkhtmltopdf did not produce a PDF (exit status {process.returncode}): {error}"
+                )
+            os.replace(temporary_path, cached_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self._evict()
+        return cached_path
+
+    def _evict(self) -> None:
+        entries = sorted(
+            (
+                entry
+                for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(".pdf")
+            ),
+            key=lambda entry: entry.stat().st_mtime,
         )
+        for entry in entries[: max(0, len(entries) - self.cache_size)]:
+            os.remove(entry.path)
+
+    def _forget(self, key: str) -> None:
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    def submit(self, html_path: str, css_path: Optional[str]) -> Future:
+        """Queue a rendering, the future resolves to the path of the PDF in the cache."""
+        key = self.content_hash(html_path, css_path)
+        cached_path = os.path.join(self.cache_dir, f"{key}.pdf")
+        with self.lock:
+            if key in self.jobs:
+                return self.jobs[key]
+            if os.path.exists(cached_path):
+                # Refresh its place in the eviction order
+                os.utime(cached_path)
+                future = Future()
+                future.set_result(cached_path)
+                return future
+            future = self.pool.submit(self._render, html_path, css_path, cached_path)
+            self.jobs[key] = future
+        future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+
+def html_to_pdf_runner_builder(config: dict[str, Any], artifacts: ArtifactStore):
+    pdf = config.get("pdf", {})
+    renderer = PDFRenderer(
+        pdf.get("cache_dir", "data/pdf_cache"),
+        pdf.get("workers", 2),
+        pdf.get("timeout", 60),
+        pdf.get("cache_size", 200),
+    )
+
+    def submit(data):
+        """Queue one conversion, returns its artifact id, output path and rendering job."""
+        if "document" in data:
+            document = artifacts.get(data["document"])
+            if document is None:
+                raise ValueError(f"No document found with id '{data['document']}'.")
+            html_path = os.path.join(document[1], "index.html")
+            css_path = os.path.join(document[1], "styles.css")
+        else:
+            html_path = artifacts.resolve(data["html"])
+            css_path = data.get("css")
+            css_path = artifacts.resolve(css_path) if css_path else None
+        output_name = os.path.basename(data.get("output", "output.pdf")) or "output.pdf"
+        future = renderer.submit(html_path, css_path)
+        # The PDF goes to its own directory so concurrent requests never overwrite it,
+        # reserved once the input is known to be valid
+        pdf_id, output_path = artifacts.new_path(output_name)
+        return pdf_id, output_path, future
+
+    def html_to_pdf_runner(input):
+        """
+        This function converts HTML and CSS files to PDF files.
+        Input is a JSON object with a 'document' id from the Document Generator, or two keys
+        'html' and 'css', both strings indicating the paths to the files.
+        'output' key is optional and specifies the PDF file name. If not provided, output.pdf
+        will be used.
+        A JSON array of such objects renders several PDFs at once.
+        """
+
+        # Extract data from input
+        try:
+            data = json.loads(input)
+        except json.JSONDecodeError:
+            raise ValueError(
+                "Invalid input. Please provide a 'document' id or 'html' and 'css' paths "
+                "in the input JSON."
+            )
+        conversions = data if isinstance(data, list) else [data]
+
+        # Queue every conversion first so they render at the same time
+        jobs = []
+        for conversion in conversions:
+            try:
+                jobs.append(submit(conversion))
+            except (KeyError, AttributeError, TypeError):
+                jobs.append(
+                    "Invalid input. Please provide a 'document' id or 'html' and 'css' paths."
+                )
+            except (ValueError, OSError) as e:
+                jobs.append(str(e))
+
+        results = []
+        for job in jobs:
+            if isinstance(job, str):
+                results.append(job)
+                continue
+            pdf_id, output_path, future = job
+            try:
+                shutil.copyfile(future.result(), output_path)
+                artifacts.register(pdf_id, "pdf", output_path)
+                results.append(
+                    f"PDF successfully created with id '{pdf_id}' at {output_path}"
+                )
+            except Exception as e:
+                artifacts.discard(pdf_id)
+                results.append(f"An error happened while creating the PDF: {str(e)}")
+        return "\n".join(results)
 
-    # Options for pdfkit, including the CSS file
-    options = {
-        "quiet": "",
-        "print-media-type": "",
-        "no-outline": None,
-        "encoding": "UTF-8",
-    }
-
-    if css_path:
-        options["user-style-sheet"] = css_path
-
-    # Convert the HTML file to PDF
-    try:
-        pdfkit.from_file(html_path, output_path, options=options)
-        return f"PDF successfully created at {output_path}"
-    except Exception as e:
-        return f"An error happened but it might just be a warning: {str(e)}, the PDF if it was created is accessible at {output_path}"
+    return html_to_pdf_runner
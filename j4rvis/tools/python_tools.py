@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import zlib
+import select
+import sqlite3
+import threading
+import subprocess
+from collections import OrderedDict
+from typing import Any, Optional
+from uuid import uuid4
+from .parsers import remove_code_block
+from .session import session_id
+
+WORKER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "python_worker.py"
+)
+
+
+class PythonWorker:
+    """A pre-warmed Python subprocess keeping the namespaces of its sessions.
+
+    Sessions share the process, so a reset caused by one of them loses the
+    namespaces of all, the others are told on their next run.
+    """
+
+    def __init__(self, limits: dict[str, Any]) -> None:
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.process = None
+        # Incremented on every new process, sessions remember the one they ran in
+        self.generation = 0
+        self.sessions: OrderedDict[str, int] = OrderedDict()
+        self._spawn()
+
+    def _spawn(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", WORKER_PATH, json.dumps(self.limits)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.generation += 1
+
+    def _ran(self, session: str) -> None:
+        self.sessions[session] = self.generation
+        while len(self.sessions) > 4 * self.limits.get("max_sessions", 32):
+            self.sessions.popitem(last=False)
+
+    def run(self, session: str, code: str, timeout: float) -> str:
+        with self.lock:
+            if self.process.poll() is not None:
+                self._spawn()
+            known = session in self.sessions
+            reset = self.sessions.pop(session, self.generation) != self.generation
+            request = json.dumps({"session": session, "code": code}) + "\n"
+            try:
+                self.process.stdin.write(request)
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                self._spawn()
+                reset = known
+                self.process.stdin.write(request)
+                self.process.stdin.flush()
+
+            ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+            if not ready:
+                self._spawn()
+                self._ran(session)
+                return (
+                    f"The code did not finish within {timeout} seconds, "
+                    "the Python session was reset."
+                )
+            line = self.process.stdout.readline()
+            if not line:
+                self._spawn()
+                self._ran(session)
+                return (
+                    "The Python process was stopped for exceeding its CPU or memory "
+                    "limits, the Python session was reset."
+                )
+            self._ran(session)
+            output = json.loads(line)["output"]
+            if reset:
+                return (
+                    "[The Python session was reset since the last call, "
+                    f"the variables defined before are lost.]\n{output}"
+                )
+            return output
+
+
+class SessionRegistry:
+    """Server process that last ran each session, shared by the processes in SQLite.
+
+    With several server workers the requests of a conversation can reach
+    different processes, the variables of a session only live in one of them.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000) -> None:
+        self.max_entries = max_entries
+        # Identifies this process, even when a restarted one gets the same pid
+        self.owner = f"{os.getpid()}-{uuid4().hex}"
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, owner TEXT, ran REAL)"
+        )
+        self.db.commit()
+
+    def moved(self, session: str) -> bool:
+        """Record a run of the session here, and whether it last ran in another process."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT owner FROM sessions WHERE session = ?", (session,)
+            ).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                (session, self.owner, time.time()),
+            )
+            (count,) = self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()
+            if count > self.max_entries:
+                self.db.execute(
+                    "DELETE FROM sessions WHERE session IN "
+                    "(SELECT session FROM sessions ORDER BY ran LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self.db.commit()
+        return row is not None and row[0] != self.owner
+
+
+class PythonREPLPool:
+    """Python workers running the REPL code off the server process.
+
+    A session always goes to the same worker, so the variables it defines
+    survive across tool calls of the same conversation. Across server
+    processes they do not, the registry tells when a session changed process.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        limits: dict[str, Any],
+        timeout: float,
+        registry: Optional[SessionRegistry] = None,
+    ) -> None:
+        self.workers = [PythonWorker(limits) for _ in range(size)]
+        self.timeout = timeout
+        self.registry = registry
+
+    def run(self, code: str) -> str:
+        session = session_id.get()
+        worker = self.workers[zlib.crc32(session.encode("utf-8")) % len(self.workers)]
+        moved = self.registry is not None and self.registry.moved(session)
+        output = worker.run(session, remove_code_block(code), self.timeout)
+        if moved:
+            return (
+                "[The previous Python calls of this conversation ran in another server "
+                f"process, the variables they defined are not available here.]\n{output}"
+            )
+        return output
+
+
+def python_repl_runner_builder(config: dict[str, Any]):
+    python = config.get("python", {})
+    registry = None
+    # Only the server workers of the supervisor can move a session between processes
+    if config.get("server", {}).get("workers", 1) > 1:
+        registry = SessionRegistry(
+            python.get("sessions_path", "data/python_sessions.sqlite")
+        )
+    pool = PythonREPLPool(
+        python.get("workers", 2),
+        {
+            "cpu_seconds": python.get("cpu_seconds", 20),
+            "memory_mb": python.get("memory_mb", 2048),
+            "max_output": python.get("max_output", 10000),
+            "max_sessions": python.get("max_sessions", 32),
+            "preload": python.get("preload", []),
+        },
+        python.get("timeout", 30),
+        registry,
+    )
+    return pool.run
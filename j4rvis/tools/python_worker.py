@@ -0,0 +1,87 @@
+"""Python REPL worker process, started by tools.python_tools.
+
+Reads one json request per line on stdin, {"session": ..., "code": ...}, runs the
+code in the namespace of the session and writes {"output": ...} on stdout.
+It only depends on the standard library so it can run as a plain script.
+"""
+
+import io
+import os
+import sys
+import json
+import importlib
+import contextlib
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # No resource limits on this platform
+    resource = None
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def limit_cpu(seconds: int) -> None:
+    """Allow the next snippet `seconds` of CPU time, the process gets SIGXCPU past it."""
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(cpu_time()) + seconds + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def run(namespace: dict, code: str, max_output: int) -> str:
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            exec(code, namespace)
+    except BaseException as e:
+        output.write(f"{type(e).__name__}: {e}")
+    text = output.getvalue()
+    if len(text) > max_output:
+        text = (
+            text[:max_output]
+            + f"\n[... {len(text) - max_output} characters truncated ...]"
+        )
+    return text
+
+
+def main() -> None:
+    limits = json.loads(sys.argv[1])
+    # Keep the real stdout for the protocol, stray writes to fd 1 go to stderr
+    protocol = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    if resource is not None and limits.get("memory_mb"):
+        memory = limits["memory_mb"] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    # Pay the heavy imports once, when the worker starts
+    for module in limits.get("preload", []):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    namespaces = OrderedDict()
+    for line in sys.stdin:
+        request = json.loads(line)
+        session = request["session"]
+        namespace = namespaces.pop(session, None) or {"__name__": "__main__"}
+        namespaces[session] = namespace
+        while len(namespaces) > limits.get("max_sessions", 32):
+            namespaces.popitem(last=False)
+
+        if resource is not None and limits.get("cpu_seconds"):
+            limit_cpu(limits["cpu_seconds"])
+        output = run(namespace, request["code"], limits.get("max_output", 10000))
+        protocol.write(json.dumps({"output": output}) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    main()
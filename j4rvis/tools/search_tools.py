@@ -0,0 +1,54 @@
+from langchain.utilities import WikipediaAPIWrapper, GoogleSearchAPIWrapper
+from .cache import TTLCache
+
+
+def _normalize(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def google_search_runner_builder(cache: TTLCache):
+    # Building the wrapper creates the discovery client, do it once per process
+    google_search = GoogleSearchAPIWrapper()
+
+    def google_search_runner(txt):
+        key = ("google", _normalize(txt))
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        results = google_search.results(txt, 10)
+        # Keep only the fields the prompt describes
+        output = str(
+            [
+                (
+                    {
+                        "title": result.get("title"),
+                        "link": result.get("link"),
+                        "snippet": result.get("snippet"),
+                    }
+                    if "Result" not in result
+                    else result
+                )
+                for result in results
+            ]
+        )
+        cache.put(key, output)
+        return output
+
+    return google_search_runner
+
+
+def wikipedia_runner_builder(cache: TTLCache, top_k_results=2, max_chars=3000):
+    wikipedia = WikipediaAPIWrapper(
+        top_k_results=top_k_results, doc_content_chars_max=max_chars
+    )
+
+    def wikipedia_runner(txt):
+        key = ("wikipedia", _normalize(txt))
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        output = wikipedia.run(txt)
+        cache.put(key, output)
+        return output
+
+    return wikipedia_runner
@@ -0,0 +1,10 @@
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Identifies the conversation a tool call belongs to, set by the server for each question
+session_id: ContextVar[str] = ContextVar("session_id", default="default")
+
+# Receives partial tool output when the client streams the answer
+event_sink: ContextVar[Optional[Callable[[Dict[str, Any]], Awaitable[None]]]] = (
+    ContextVar("event_sink", default=None)
+)
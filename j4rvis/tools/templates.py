@@ -0,0 +1,74 @@
+import os
+import re
+import shutil
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Replaced by the content of the document when it is rendered
+TITLE = "[[TITLE]]"
+SUBTITLE = "[[SUBTITLE]]"
+CONTENT = "[[CONTENT]]"
+
+
+def template_name(kind: str) -> str:
+    """Directory name of the template for a kind of document, like 'cover-letter'."""
+    name = re.sub(r"[^a-z0-9]+", "-", kind.lower()).strip("-")
+    return name[:40] or "document"
+
+
+class TemplateStore:
+    """Layout skeletons and stylesheets of generated documents, one per kind of document.
+
+    A template is generated the first time a kind of document is requested and
+    kept on disk, later documents of the same kind are rendered into it locally.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.locks: Dict[str, threading.Lock] = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def _paths(self, directory: str) -> Tuple[str, str]:
+        return os.path.join(directory, "skeleton.html"), os.path.join(
+            directory, "styles.css"
+        )
+
+    def get(self, kind: str) -> Optional[Tuple[str, str]]:
+        """Skeleton and stylesheet paths of a kind of document, if it has a template."""
+        paths = self._paths(os.path.join(self.root, template_name(kind)))
+        return paths if all(os.path.exists(path) for path in paths) else None
+
+    def get_or_create(
+        self, kind: str, generate: Callable[[str, str, str], None]
+    ) -> Tuple[str, str]:
+        """Template of a kind of document, made with generate(kind, html_path, css_path) if missing."""
+        name = template_name(kind)
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        # Requests for the same missing template wait for a single generation
+        with lock:
+            template = self.get(name)
+            if template is not None:
+                return template
+            directory = os.path.join(self.root, name)
+            staging = f"{directory}.tmp-{threading.get_ident()}"
+            os.makedirs(staging, exist_ok=True)
+            try:
+                html_path, css_path = self._paths(staging)
+                generate(kind, html_path, css_path)
+                with open(html_path, encoding="utf-8") as file:
+                    if CONTENT not in file.read():
+                        raise ValueError(f"the template does not contain {CONTENT}")
+                shutil.rmtree(directory, ignore_errors=True)
+                os.replace(staging, directory)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            return self._paths(directory)
+
+
+def configure_templates(config: dict[str, Any]) -> Optional[TemplateStore]:
+    documents = config.get("documents", {})
+    if not documents.get("templates", True):
+        return None
+    return TemplateStore(documents.get("templates_dir", "data/templates"))
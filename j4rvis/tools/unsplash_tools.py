@@ -1,26 +1,99 @@
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .cache import TTLCache
+from .parsers import parse_input
 
 
 def search_images_runner_builder(config):
     access_key = config["api"]["unsplash_access_key"]
+    unsplash = config.get("unsplash", {})
+    cache = TTLCache(unsplash.get("cache_size", 256), unsplash.get("cache_ttl", 3600))
+    rate_limit_cooldown = unsplash.get("rate_limit_cooldown", 600)
+    api_url = unsplash.get("api_url", "https://api.unsplash.com")
+    rate_limited_until = 0.0
+
+    # One session for every search, keeping connections alive and retrying server errors
+    session = requests.Session()
+    session.headers.update(
+        {"Authorization": f"Client-ID {access_key}", "Accept-Version": "v1"}
+    )
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[500, 502, 503, 504],
+                allowed_methods=["GET"],
+            ),
+        ),
+    )
+
+    def parse(txt):
+        """Query, results per page and page of a search, or why they are invalid."""
+        # Input is either a plain query or a json object with query, per_page and page
+        try:
+            data = parse_input(txt) if txt.strip().startswith("{") else {"query": txt}
+        except ValueError:
+            return (
+                None,
+                "Invalid input, give a query or a JSON object with a 'query' key.",
+            )
+        query = data.get("query")
+        if not isinstance(query, str) or not query.strip():
+            return None, "Invalid input, 'query' must be a non-empty string."
+        try:
+            per_page = int(5 if data.get("per_page") is None else data["per_page"])
+            page = int(1 if data.get("page") is None else data["page"])
+        except (TypeError, ValueError):
+            return None, "Invalid input, 'per_page' and 'page' must be integers."
+        if per_page < 1 or page < 1:
+            return None, "Invalid input, 'per_page' and 'page' must be at least 1."
+        return (" ".join(query.lower().split()), min(per_page, 30), page), None
 
     def search_images_runner(txt):
-        query = "+".join(txt.split())  # Convert spaces in the query to '+'
-        url = f"https://api.unsplash.com/search/photos?query={query}&client_id={access_key}"
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        results = data["results"]
-        return str(
+        nonlocal rate_limited_until
+        search, error = parse(txt)
+        if error is not None:
+            return error
+        query, per_page, page = search
+
+        key = (query, per_page, page)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        if time.monotonic() < rate_limited_until:
+            return "The Unsplash rate limit is reached, try again later."
+
+        response = session.get(
+            f"{api_url}/search/photos",
+            params={"query": query, "per_page": per_page, "page": page},
+            timeout=10,
+        )
+        if response.headers.get("X-Ratelimit-Remaining") == "0" or (
+            response.status_code == 403 and "Rate Limit" in response.text
+        ):
+            rate_limited_until = time.monotonic() + rate_limit_cooldown
+        if response.status_code != 200:
+            return f"Unsplash search failed with status {response.status_code}."
+
+        results = response.json()["results"]
+        output = str(
             [
                 {
-                    "description": x["description"]
-                    if x["description"]
-                    else x["alt_description"],
+                    "description": (
+                        x["description"] if x["description"] else x["alt_description"]
+                    ),
                     "full_image": x["urls"]["raw"],
                     "small_image": x["urls"]["small"],
                 }
                 for x in results
             ]
         )
+        cache.put(key, output)
+        return output
 
     return search_images_runner
@@ -0,0 +1,146 @@
+import os
+import time
+import shutil
+import sqlite3
+import threading
+from uuid import uuid4
+from typing import Any, Optional, Tuple
+from .session import session_id
+
+
+def _size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path)
+        for name in names
+    )
+
+
+class ArtifactStore:
+    """Files generated by the tools, in one workspace per session and indexed by id.
+
+    Artifacts older than ttl seconds are deleted, and the oldest ones go first
+    when the workspaces grow past the disk quota.
+    """
+
+    def __init__(self, root: str, ttl: float, quota_bytes: int) -> None:
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        self.quota_bytes = quota_bytes
+        self.lock = threading.Lock()
+        self.cleaned_at = 0.0
+        os.makedirs(self.root, exist_ok=True)
+        # Shared by the server processes, a busy database is waited for
+        self.db = sqlite3.connect(
+            os.path.join(self.root, "artifacts.sqlite"),
+            check_same_thread=False,
+            timeout=30,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            "id TEXT PRIMARY KEY, session TEXT, kind TEXT, path TEXT, size INTEGER, created REAL)"
+        )
+        self.db.commit()
+
+    def new_path(self, name: str) -> Tuple[str, str]:
+        """Reserve an artifact id and a path for it in the workspace of the session.
+
+        The directory is indexed as 'pending' until the artifact is registered,
+        so the TTL cleans it up when the tool fails before that.
+        """
+        id = uuid4().hex[:12]
+        directory = os.path.join(self.root, session_id.get(), id)
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO artifacts VALUES (?, ?, 'pending', ?, 0, ?)",
+                (id, session_id.get(), directory, time.time()),
+            )
+            self.db.commit()
+        return id, os.path.join(directory, name)
+
+    def register(self, id: str, kind: str, path: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)",
+                (id, session_id.get(), kind, path, _size(path), time.time()),
+            )
+            self.db.commit()
+        self.cleanup()
+
+    def discard(self, id: str) -> None:
+        """Delete an artifact that could not be produced."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT path FROM artifacts WHERE id = ?", (id,)
+            ).fetchone()
+            if row is not None:
+                self._delete(id, row[0])
+                self.db.commit()
+
+    def get(self, id: str) -> Optional[Tuple[str, str]]:
+        """Kind and path of an artifact, once it is registered."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT kind, path FROM artifacts WHERE id = ? AND kind != 'pending'",
+                (id,),
+            ).fetchone()
+        return row
+
+    def resolve(self, reference: str) -> str:
+        """Path of an artifact id, other references are returned as paths unchanged."""
+        artifact = self.get(reference.strip())
+        return artifact[1] if artifact else reference
+
+    def _delete(self, id: str, path: str) -> None:
+        # Artifacts live in their own directory, named after their id
+        directory = os.path.dirname(path) if os.path.isfile(path) else path
+        if os.path.basename(directory) == id:
+            shutil.rmtree(directory, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        self.db.execute("DELETE FROM artifacts WHERE id = ?", (id,))
+
+    def cleanup(self, force: bool = False) -> None:
+        now = time.time()
+        with self.lock:
+            if not force and now - self.cleaned_at < 60:
+                return
+            self.cleaned_at = now
+            for id, path in self.db.execute(
+                "SELECT id, path FROM artifacts WHERE created < ?", (now - self.ttl,)
+            ).fetchall():
+                self._delete(id, path)
+            (total,) = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM artifacts"
+            ).fetchone()
+            for id, path, size in self.db.execute(
+                "SELECT id, path, size FROM artifacts ORDER BY created"
+            ).fetchall():
+                if total <= self.quota_bytes:
+                    break
+                self._delete(id, path)
+                total -= size
+            self.db.commit()
+
+
+_store: Optional[ArtifactStore] = None
+
+
+def configure_artifacts(config: dict[str, Any]) -> ArtifactStore:
+    global _store
+    workspace = config.get("workspace", {})
+    _store = ArtifactStore(
+        workspace.get("root", "data/workspaces"),
+        workspace.get("ttl", 86400),
+        workspace.get("quota_mb", 500) * 1024 * 1024,
+    )
+    _store.cleanup(force=True)
+    return _store
+
+
+def get_artifacts() -> Optional[ArtifactStore]:
+    return _store
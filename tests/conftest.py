@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The server runs from the j4rvis directory, its modules import each other from there
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "j4rvis"))
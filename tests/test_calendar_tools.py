@@ -0,0 +1,215 @@
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+pytest.importorskip("caldav")
+pytest.importorskip("icalendar")
+pytest.importorskip("pytz")
+
+from tools.calendar_tools import calendar_tool_builder  # noqa: E402
+
+EVENT = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//j4rvis tests//EN
+BEGIN:VEVENT
+UID:{uid}
+DTSTAMP:20240101T000000Z
+DTSTART:{start}
+DTEND:{end}
+SUMMARY:{summary}
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def response(href, props):
+    return (
+        f"<d:response><d:href>{href}</d:href><d:propstat><d:prop>{props}</d:prop>"
+        "<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+    )
+
+
+def multistatus(*responses):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">'
+        + "".join(responses)
+        + "</d:multistatus>"
+    ).encode("utf-8")
+
+
+class CalDAVStandIn:
+    """A local CalDAV server with one 'Jarvis' calendar, counting the requests it gets."""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.events = {}
+        self.changed = []
+        self.token = 1
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, body):
+                self.send_response(207)
+                self.send_header("Content-Type", 'application/xml; charset="utf-8"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_PROPFIND(self):
+                body = self.rfile.read(
+                    int(self.headers.get("Content-Length", 0))
+                ).decode()
+                if "current-user-principal" in body:
+                    stand_in.requests["principal"] += 1
+                    props = (
+                        "<d:current-user-principal><d:href>/principal/</d:href>"
+                        "</d:current-user-principal>"
+                    )
+                    return self._reply(multistatus(response(self.path, props)))
+                if "calendar-home-set" in body:
+                    stand_in.requests["home"] += 1
+                    props = (
+                        "<c:calendar-home-set><d:href>/calendars/</d:href>"
+                        "</c:calendar-home-set>"
+                    )
+                    return self._reply(multistatus(response(self.path, props)))
+                if "sync-token" in body:
+                    stand_in.requests["sync-token"] += 1
+                    props = f"<d:sync-token>token-{stand_in.token}</d:sync-token>"
+                    return self._reply(multistatus(response(self.path, props)))
+                stand_in.requests["calendars"] += 1
+                self._reply(
+                    multistatus(
+                        response(
+                            "/calendars/",
+                            "<d:resourcetype><d:collection/></d:resourcetype>",
+                        ),
+                        response(
+                            "/calendars/jarvis/",
+                            "<d:displayname>Jarvis</d:displayname><d:resourcetype>"
+                            "<d:collection/><c:calendar/></d:resourcetype>",
+                        ),
+                    )
+                )
+
+            def do_REPORT(self):
+                body = self.rfile.read(
+                    int(self.headers.get("Content-Length", 0))
+                ).decode()
+                responses = []
+                if "sync-collection" in body:
+                    stand_in.requests["sync-collection"] += 1
+                    hrefs = stand_in.changed
+                    responses.append(
+                        f"<d:sync-token>token-{stand_in.token}</d:sync-token>"
+                    )
+                else:
+                    stand_in.requests["calendar-query"] += 1
+                    hrefs = list(stand_in.events)
+                responses[:0] = [
+                    response(
+                        href,
+                        f'<d:getetag>"{href}"</d:getetag>'
+                        f"<c:calendar-data>{stand_in.events[href]}</c:calendar-data>",
+                    )
+                    for href in hrefs
+                ]
+                self._reply(multistatus(*responses))
+
+            def do_GET(self):
+                data = stand_in.events[self.path].encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/calendar")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add_event(self, uid, summary, start, end):
+        href = f"/calendars/jarvis/{uid}.ics"
+        self.events[href] = EVENT.format(uid=uid, summary=summary, start=start, end=end)
+        self.changed.append(href)
+        self.token += 1
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def caldav_server():
+    server = CalDAVStandIn()
+    server.add_event("standup", "Standup", "20240102T090000", "20240102T093000")
+    server.changed = []
+    yield server
+    server.close()
+
+
+def calendar_tool(server, events_ttl):
+    return calendar_tool_builder(
+        {
+            "calendar": {
+                "server_url": server.url,
+                "username": "jarvis",
+                "password": "secret",
+                "events_ttl": events_ttl,
+            }
+        }
+    )
+
+
+def get_events(tool):
+    return tool(
+        json.dumps(
+            {
+                "action": "get_events",
+                "data": {"from_dt": "2024-01-01", "to_dt": "2024-01-03"},
+            }
+        )
+    )
+
+
+def test_calendars_are_discovered_once(caldav_server):
+    tool = calendar_tool(caldav_server, events_ttl=30)
+    first = get_events(tool)
+    second = get_events(tool)
+
+    assert [event["summary"] for event in first] == ["Standup"]
+    assert second == first
+    assert caldav_server.requests["principal"] == 1
+    assert caldav_server.requests["calendars"] == 1
+    # The second search is answered from the event cache
+    assert caldav_server.requests["calendar-query"] == 1
+
+
+def test_changed_events_are_synced_incrementally(caldav_server):
+    tool = calendar_tool(caldav_server, events_ttl=0)
+    get_events(tool)
+    caldav_server.add_event("review", "Review", "20240101T140000Z", "20240101T150000Z")
+    events = get_events(tool)
+
+    # Sorted by time, across naive and zoned events
+    assert [event["summary"] for event in events] == ["Review", "Standup"]
+    assert caldav_server.requests["calendar-query"] == 1
+    assert caldav_server.requests["sync-collection"] == 1
+
+
+def test_unchanged_calendar_is_not_searched_again(caldav_server):
+    tool = calendar_tool(caldav_server, events_ttl=0)
+    get_events(tool)
+    get_events(tool)
+
+    assert caldav_server.requests["calendar-query"] == 1
+    assert caldav_server.requests["sync-collection"] == 0
+    assert caldav_server.requests["sync-token"] == 2
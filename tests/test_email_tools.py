@@ -0,0 +1,180 @@
+import json
+import socket
+import smtplib
+import email
+import pytest
+
+aiosmtpd = pytest.importorskip("aiosmtpd")
+
+from aiosmtpd.controller import Controller  # noqa: E402
+from aiosmtpd.smtp import AuthResult  # noqa: E402
+from tools.email_tools import (  # noqa: E402
+    ATTACHMENT_CHUNK_SIZE,
+    email_deliverer_builder,
+    send_email_builder,
+)
+
+
+class Recorder:
+    """aiosmtpd handler keeping the messages and counting the commands of the pool."""
+
+    def __init__(self):
+        self.messages = []
+        self.logins = 0
+        self.noops = 0
+        self.resets = 0
+        self.refused = set()
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data):
+        self.logins += 1
+        return AuthResult(success=True)
+
+    async def handle_NOOP(self, server, session, envelope, arg):
+        self.noops += 1
+        return "250 OK"
+
+    async def handle_RSET(self, server, session, envelope):
+        self.resets += 1
+        return "250 OK"
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return "550 no such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(email.message_from_bytes(envelope.content))
+        return "250 Message accepted for delivery"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    # The pool speaks implicit TLS, the stand-in is plain SMTP on localhost
+    monkeypatch.setattr(smtplib, "SMTP_SSL", smtplib.SMTP)
+    recorder = Recorder()
+    controller = Controller(
+        recorder,
+        hostname="127.0.0.1",
+        port=free_port(),
+        authenticator=recorder.authenticate,
+        auth_require_tls=False,
+    )
+    controller.start()
+    recorder.port = controller.port
+    yield recorder
+    controller.stop()
+
+
+def deliverer(server):
+    return email_deliverer_builder(
+        "jarvis@example.com", "secret", "127.0.0.1", server.port
+    )
+
+
+def test_attachment_is_streamed_intact(smtp_server, tmp_path):
+    # Several chunks, the last one partial, with bytes of every value
+    content = bytes(range(256)) * (3 * ATTACHMENT_CHUNK_SIZE // 256 + 7)
+    attachment = tmp_path / "report.pdf"
+    attachment.write_bytes(content)
+
+    deliverer(smtp_server)(
+        {
+            "to_email": "user@example.com",
+            "subject": "Réunion",
+            "body": "<p>Hello</p>\n.\n.starts with a period",
+            "files": [str(attachment)],
+        }
+    )
+
+    (message,) = smtp_server.messages
+    parts = [part for part in message.walk() if not part.is_multipart()]
+    assert ".starts with a period" in parts[0].get_payload(decode=True).decode("utf-8")
+    assert parts[1].get_filename() == "report.pdf"
+    assert parts[1].get_payload(decode=True) == content
+
+
+def test_sessions_are_reused_after_a_noop(smtp_server):
+    deliver = deliverer(smtp_server)
+    for index in range(3):
+        deliver({"to_email": "user@example.com", "subject": f"#{index}", "body": "hi"})
+
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.logins == 1
+    # Checked before each reuse
+    assert smtp_server.noops == 2
+
+
+def test_failed_transaction_is_reset_and_the_session_kept(smtp_server):
+    smtp_server.refused.add("nobody@example.com")
+    deliver = deliverer(smtp_server)
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        deliver({"to_email": "nobody@example.com", "subject": "lost", "body": "hi"})
+    deliver({"to_email": "user@example.com", "subject": "found", "body": "hi"})
+
+    assert smtp_server.resets == 1
+    assert smtp_server.logins == 1
+    assert [message["Subject"] for message in smtp_server.messages] == ["found"]
+
+
+def test_header_injection_is_refused(smtp_server):
+    deliver = deliverer(smtp_server)
+
+    with pytest.raises(ValueError):
+        deliver({"to_email": "a@b.c\r\nBcc: evil@x.y", "subject": "hi", "body": "hi"})
+
+    assert smtp_server.messages == []
+
+
+class Outbox:
+    def __init__(self):
+        self.queued = []
+
+    def enqueue(self, data):
+        self.queued.append(data)
+        return str(len(self.queued))
+
+
+class NoArtifacts:
+    def get(self, id):
+        return None
+
+    def resolve(self, reference):
+        return reference
+
+
+def test_invalid_emails_are_refused_before_queueing(tmp_path):
+    outbox = Outbox()
+    send_email = send_email_builder(outbox, NoArtifacts())
+    emails = [
+        {"to_email": "a@b.c\r\nBcc: evil@x.y", "subject": "hi", "body": "hi"},
+        {"to_email": "a@b.c", "subject": "hi\nBcc: evil@x.y", "body": "hi"},
+        {"to_email": "not an address", "subject": "hi", "body": "hi"},
+        {
+            "to_email": "a@b.c",
+            "subject": "hi",
+            "body": "hi",
+            "files": [str(tmp_path / "none")],
+        },
+        {"to_email": "Jean <jean@example.com>", "subject": "hi", "body": "hi"},
+    ]
+
+    results = send_email(json.dumps(emails)).split("\n")
+
+    assert [
+        result.endswith("queued for delivery with id '1'.") for result in results
+    ] == [
+        False,
+        False,
+        False,
+        False,
+        True,
+    ]
+    assert len(outbox.queued) == 1
@@ -0,0 +1,27 @@
+from tools.python_tools import PythonREPLPool, SessionRegistry
+from tools.session import session_id
+
+LIMITS = {
+    "cpu_seconds": 5,
+    "memory_mb": 512,
+    "max_output": 1000,
+    "max_sessions": 4,
+    "preload": [],
+}
+
+
+def test_session_moved_to_another_process_is_reported(tmp_path):
+    path = str(tmp_path / "python_sessions.sqlite")
+    # Two pools sharing the registry stand for two server processes
+    first = PythonREPLPool(1, LIMITS, 10, SessionRegistry(path))
+    second = PythonREPLPool(1, LIMITS, 10, SessionRegistry(path))
+    session_id.set("conversation")
+
+    assert first.run("x = 1\nprint(x)") == "1\n"
+    assert first.run("print(x)") == "1\n"
+    moved = second.run("print(x)")
+    assert moved.startswith(
+        "[The previous Python calls of this conversation ran in another"
+    )
+    assert "NameError" in moved
+    assert second.run("print(2)") == "2\n"
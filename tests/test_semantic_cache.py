@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("faiss")
+pytest.importorskip("langchain")
+
+from semantic_cache import HashingEmbedder, SemanticCache  # noqa: E402
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "semantic_cache.sqlite")
+
+
+def test_similar_question_is_a_hit(path):
+    cache = SemanticCache(HashingEmbedder(), path, threshold=0.8)
+    cache.add(
+        "What is the capital of France?",
+        "Paris",
+        cache.embed("What is the capital of France?"),
+    )
+
+    assert cache.lookup(cache.embed("what is the capital city of france")) == "Paris"
+
+
+def test_different_question_is_a_miss(path):
+    cache = SemanticCache(HashingEmbedder(), path, threshold=0.8)
+    cache.add(
+        "What is the capital of France?",
+        "Paris",
+        cache.embed("What is the capital of France?"),
+    )
+
+    assert cache.lookup(cache.embed("How tall is the Eiffel tower?")) is None
+
+
+def test_answers_survive_reopening(path):
+    question = "Who wrote Les Miserables?"
+    cache = SemanticCache(HashingEmbedder(), path, threshold=0.8)
+    cache.add(question, "Victor Hugo", cache.embed(question))
+    cache.db.close()
+
+    reopened = SemanticCache(HashingEmbedder(), path, threshold=0.8)
+    assert reopened.lookup(reopened.embed(question)) == "Victor Hugo"
@@ -0,0 +1,72 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pytest
+
+pytest.importorskip("requests")
+
+from tools.unsplash_tools import search_images_runner_builder  # noqa: E402
+
+PHOTO = {
+    "description": "A red fox",
+    "alt_description": "fox in the snow",
+    "urls": {
+        "raw": "https://images.example/fox",
+        "small": "https://images.example/fox-s",
+    },
+}
+
+
+@pytest.fixture
+def unsplash():
+    """A local stand-in of the Unsplash search API, recording the queries it gets."""
+    queries = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            queries.append(parse_qs(urlparse(self.path).query))
+            body = json.dumps({"results": [PHOTO]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = {
+        "api": {"unsplash_access_key": "key"},
+        "unsplash": {"api_url": f"http://127.0.0.1:{server.server_port}"},
+    }
+    yield search_images_runner_builder(config), queries
+    server.shutdown()
+    server.server_close()
+
+
+def test_missing_parameters_get_defaults(unsplash):
+    search, queries = unsplash
+    output = search('{"query": "Red  Fox", "per_page": null}')
+
+    assert "https://images.example/fox" in output
+    assert queries == [{"query": ["red fox"], "per_page": ["5"], "page": ["1"]}]
+
+
+@pytest.mark.parametrize(
+    "txt",
+    [
+        '{"per_page": 3}',
+        '{"query": 42}',
+        '{"query": "fox", "per_page": "many"}',
+        '{"query": "fox", "page": 0}',
+        '{"query": "fox",',
+    ],
+)
+def test_invalid_input_is_refused_without_a_request(unsplash, txt):
+    search, queries = unsplash
+
+    assert search(txt).startswith("Invalid input")
+    assert queries == []